@@ -0,0 +1,154 @@
+"""Admission control and request coalescing in front of the LLM.
+
+Each model tier gets a token bucket: a call takes one token, tokens refill at
+LLM_RATE_<TIER> per second up to LLM_BURST_<TIER>, and a call that would have to wait
+longer than LLM_ADMISSION_MAX_WAIT seconds for its token is refused with Overloaded
+instead of being sent upstream to collect a 429. A rate of 0 disables the bucket.
+
+LLM_RATE_* and LLM_BURST_* are the limits for the whole deployment. The buckets live in
+each process, so they are divided by LLM_ADMISSION_WORKERS, which gunicorn.conf.py sets
+to its worker count. Multiple hosts still each get the full rate.
+
+single_flight() lets concurrent requests for the same key share one computation: the
+first caller runs it and the rest wait, for at most SINGLE_FLIGHT_MAX_WAIT seconds, for
+its result.
+"""
+import math
+import os
+import re
+import threading
+import time
+
+import metrics
+
+LLM_ADMISSION_MAX_WAIT = float(os.getenv("LLM_ADMISSION_MAX_WAIT", "5"))
+LLM_ADMISSION_WORKERS = max(1, int(os.getenv("LLM_ADMISSION_WORKERS", "1")))
+# Keep well under gunicorn's worker timeout, which also has to cover the guard and rewrite
+SINGLE_FLIGHT_MAX_WAIT = float(os.getenv("SINGLE_FLIGHT_MAX_WAIT", "60"))
+
+DEFAULT_LIMITS = {
+    "small": ("20", "40"),
+    "large": ("8", "16"),
+}
+
+
+class Overloaded(Exception):
+    """Raised when an LLM call can't be admitted, or a coalesced answer doesn't arrive, in time."""
+
+    def __init__(self, tier, retry_after, message=None):
+        super().__init__(message or f"LLM tier {tier!r} is saturated; retry in {retry_after}s")
+        self.tier = tier
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Token bucket that hands out reservations, so waiting callers are served in arrival order."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """Return (admitted, wait): how long to sleep before calling, or how long until a retry could succeed."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Tokens go negative while callers are queued; each one waits for its own token
+            wait = max(0.0, (1 - self._tokens) / self.rate)
+            if wait > max_wait:
+                return False, wait - max_wait
+            self._tokens -= 1
+            return True, wait
+
+
+def _bucket(tier):
+    rate, burst = DEFAULT_LIMITS.get(tier, DEFAULT_LIMITS["large"])
+    rate = float(os.getenv(f"LLM_RATE_{tier.upper()}", rate)) / LLM_ADMISSION_WORKERS
+    burst = int(os.getenv(f"LLM_BURST_{tier.upper()}", burst)) // LLM_ADMISSION_WORKERS
+    return TokenBucket(rate, burst) if rate > 0 else None
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def admit(tier):
+    """Block until the tier has capacity for one more call, or raise Overloaded."""
+    with _buckets_lock:
+        if tier not in _buckets:
+            _buckets[tier] = _bucket(tier)
+        bucket = _buckets[tier]
+    if bucket is None:
+        return
+    admitted, wait = bucket.reserve(LLM_ADMISSION_MAX_WAIT)
+    if not admitted:
+        metrics.inc("amverse_admission_total", tier=tier, result="rejected")
+        raise Overloaded(tier, max(1, math.ceil(wait)))
+    metrics.inc("amverse_admission_total", tier=tier, result="admitted")
+    metrics.observe("amverse_admission_wait_seconds", wait, tier=tier)
+    if wait:
+        time.sleep(wait)
+
+
+def normalize_query(query):
+    """Fold case, whitespace and trailing punctuation so trivially different phrasings coalesce."""
+    return re.sub(r"\s+", " ", query.lower()).strip().rstrip("?.! ")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def single_flight(key, compute, timeout=None):
+    """Return (result, shared); callers with the same key while one is running get its result.
+
+    A caller that waits longer than `timeout` (default SINGLE_FLIGHT_MAX_WAIT) for the
+    running computation gets Overloaded instead.
+    """
+    with _inflight_lock:
+        call = _inflight.get(key)
+        leader = call is None
+        if leader:
+            call = _inflight[key] = _Call()
+
+    if not leader:
+        timeout = SINGLE_FLIGHT_MAX_WAIT if timeout is None else timeout
+        started = time.perf_counter()
+        finished = call.done.wait(timeout)
+        metrics.observe("amverse_singleflight_wait_seconds", time.perf_counter() - started)
+        if not finished:
+            metrics.inc("amverse_singleflight_total", result="timeout")
+            raise Overloaded(None, max(1, math.ceil(LLM_ADMISSION_MAX_WAIT)), f"Coalesced request gave up after {timeout:g}s")
+        metrics.inc("amverse_singleflight_total", result="shared")
+        if call.error is not None:
+            raise call.error
+        return call.result, True
+
+    metrics.inc("amverse_singleflight_total", result="leader")
+    try:
+        call.result = compute()
+        return call.result, False
+    except BaseException as e:
+        call.error = e
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        call.done.set()
+
+
+metrics.describe("amverse_admission_total", "LLM calls admitted or rejected by the per-tier token bucket.")
+metrics.describe("amverse_admission_wait_seconds", "Time admitted LLM calls waited for a token.")
+metrics.describe("amverse_singleflight_total", "Coalesced requests: computed (leader), reused (shared) or gave up waiting (timeout).")
+metrics.describe("amverse_singleflight_wait_seconds", "Time shared requests waited for the leader's answer.")
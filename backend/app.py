@@ -1,30 +1,43 @@
-from flask import Flask, request, jsonify
+import time
+
+# Measured before the heavy imports below so startup time covers them
+APP_IMPORT_STARTED = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, has_request_context
 import logging
+import threading
 from langchain.prompts import PromptTemplate
 from langchain.chains import RetrievalQA
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_elasticsearch import ElasticsearchStore
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 import os
 from langchain.schema import Document
+from langchain_core.embeddings import Embeddings
 from flask_cors import CORS
 import pdfplumber
 import re
 from collections import defaultdict
-from langchain.text_splitter import NLTKTextSplitter, RecursiveCharacterTextSplitter
-import nltk
+from langchain.text_splitter import RecursiveCharacterTextSplitter
 import tiktoken
 import tempfile
-from concurrent.futures import ThreadPoolExecutor
-from sentence_transformers import util
-from pdf2image import convert_from_path
+import shutil
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 from supabase import create_client
-import fitz
 from elasticsearch.exceptions import NotFoundError
-from elasticsearch import Elasticsearch
-
-nltk.download('punkt')
+from werkzeug.exceptions import RequestEntityTooLarge
+import metrics
+import tracing
+import vector_store
+import screenshots
+import prompt_cache
+import model_router
+import admission
+import dedup
+from urllib.parse import quote
 
 load_dotenv()
 
@@ -33,20 +46,178 @@ CORS(app, resources={r"/*": {"origins": ["http://localhost:3000", "http://127.0.
 logging.basicConfig(level=logging.INFO)
 
 # Load environment variables
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGCHAIN_API_KEY")
-os.environ["ES_API_KEY"] = os.getenv("ES_API_KEY")
-os.environ["ES_CLOUD_ID"] = os.getenv("ES_CLOUD_ID")
-os.environ["OPENAI_API_KEY"] = os.getenv("OPENAI_API_KEY")
+# LangSmith tracing is opt-in; request timings are recorded locally by tracing.py
+os.environ["LANGCHAIN_TRACING_V2"] = os.getenv("LANGCHAIN_TRACING_V2", "false")
+for required_var in ("OPENAI_API_KEY", "ES_API_KEY", "ES_CLOUD_ID", "SUPABASE_URL", "SUPABASE_KEY"):
+    if not os.getenv(required_var):
+        logging.warning(f"{required_var} is not set; endpoints that need it will fail until it is.")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-tokenizer = tiktoken.get_encoding("cl100k_base")
+# Offline assets fetched with `python fetch_assets.py`; the environment can point elsewhere
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor")
+if os.path.isdir(os.path.join(VENDOR_DIR, "tiktoken")):
+    os.environ.setdefault("TIKTOKEN_CACHE_DIR", os.path.join(VENDOR_DIR, "tiktoken"))
+# Base URL the frontend uses to reach this API; page screenshot URLs are built from it
+PUBLIC_API_URL = os.getenv("PUBLIC_API_URL", "http://127.0.0.1:5000").rstrip("/")
+SOURCE_BUCKET = os.getenv("SOURCE_BUCKET", "screenshots")
+SCREENSHOT_BROWSER_MAX_AGE = int(os.getenv("SCREENSHOT_BROWSER_MAX_AGE", "86400"))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1))))
+INGEST_UPLOAD_THREADS = int(os.getenv("INGEST_UPLOAD_THREADS", "8"))
+INGEST_BATCH_MAX_FILES = int(os.getenv("INGEST_BATCH_MAX_FILES", "200"))
+# Uncompressed bytes a batch may write to disk, and the most any single PDF may take
+INGEST_BATCH_MAX_BYTES = int(os.getenv("INGEST_BATCH_MAX_BYTES", str(1024 * 1024 * 1024)))
+INGEST_MAX_FILE_BYTES = int(os.getenv("INGEST_MAX_FILE_BYTES", str(100 * 1024 * 1024)))
+# Room for the multipart boundaries and form fields around the files themselves
+INGEST_FORM_OVERHEAD_BYTES = 1024 * 1024
+# Werkzeug refuses larger request bodies with a 413 before any of it is written to disk
+app.config['MAX_CONTENT_LENGTH'] = INGEST_BATCH_MAX_BYTES + INGEST_FORM_OVERHEAD_BYTES
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-mpnet-base-v2")
+# Chunks put in the prompt, and how many are fetched so near-duplicates can be dropped first
+RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "5"))
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "10"))
+NLTK_ALLOW_DOWNLOAD = os.getenv("NLTK_ALLOW_DOWNLOAD", "false").lower() == "true"
+
+# Heavy resources are loaded on first use, or up front by warmup()
+_resource_lock = threading.Lock()
+_tokenizer = None
+_embeddings = None
+_warmed_up = False
+
+
+def get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        with _resource_lock:
+            if _tokenizer is None:
+                _tokenizer = tiktoken.get_encoding("cl100k_base")
+    return _tokenizer
+
+
+def wants_debug_timings():
+    if request.args.get("debug_timings") == "1" or request.headers.get("X-Debug-Timings") == "1":
+        return True
+    data = request.get_json(silent=True) if request.is_json else None
+    return isinstance(data, dict) and bool(data.get("debug_timings"))
+
+@app.before_request
+def begin_request_trace():
+    request.environ["amverse.trace_span"] = tracing.start_trace(request.endpoint or request.path, method=request.method)
+
+@app.after_request
+def end_request_trace(response):
+    span = request.environ.get("amverse.trace_span")
+    trace = tracing.finish_trace(span, status=response.status_code) if span else None
+    if trace and wants_debug_timings():
+        data = response.get_json(silent=True)
+        if isinstance(data, dict):
+            data["timings"] = {"trace_id": trace["trace_id"], "spans": tracing.waterfall(trace)}
+            response.set_data(app.json.dumps(data))
+    return response
+
+@app.teardown_request
+def close_request_trace(error=None):
+    # after_request is skipped when a view raises, so make sure the trace is still written
+    span = request.environ.get("amverse.trace_span")
+    if span:
+        tracing.finish_trace(span, error=type(error).__name__ if error else None)
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    return jsonify({'success': False, 'message': 'Upload exceeds the size limit.'}), 413
+
+
+@app.errorhandler(admission.Overloaded)
+def llm_overloaded(error):
+    logging.warning(str(error))
+    response = jsonify({
+        "response": "We're handling a lot of questions right now. Please try again in a moment.",
+        "retry_after": error.retry_after,
+    })
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+def stage(name):
+    """Time a pipeline stage, labelled with the endpoint currently being served."""
+    pipeline = request.endpoint if has_request_context() and request.endpoint else "background"
+    return metrics.track_stage(pipeline, name)
+
+
+class TimedEmbeddings(Embeddings):
+    """Delegates to the wrapped model and records each call as the `embed` stage."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def embed_documents(self, texts):
+        metrics.inc("amverse_embedded_texts_total", len(texts), kind="document")
+        with stage("embed"):
+            return self.inner.embed_documents(texts)
+
+    def embed_query(self, text):
+        metrics.inc("amverse_embedded_texts_total", kind="query")
+        with stage("embed"):
+            return self.inner.embed_query(text)
+
+
+def get_embeddings():
+    global _embeddings
+    if _embeddings is None:
+        with _resource_lock:
+            if _embeddings is None:
+                # Importing sentence-transformers pulls in torch, so it is deferred as well
+                from langchain_huggingface import HuggingFaceEmbeddings
+                with metrics.track_stage("startup", "load_embeddings"):
+                    _embeddings = TimedEmbeddings(HuggingFaceEmbeddings(
+                        model_name=EMBEDDING_MODEL,
+                        model_kwargs={'device': 'cpu'}
+                    ))
+    return _embeddings
+
+
+def set_embeddings(model):
+    """Swap in a different embeddings model, e.g. for benchmarks."""
+    global _embeddings
+    _embeddings = TimedEmbeddings(model)
+
 
-embeddings = HuggingFaceEmbeddings(
-    model_name='sentence-transformers/all-mpnet-base-v2',
-    model_kwargs={'device': 'cpu'}
-)
+def ensure_nltk_data():
+    """Make punkt available from the vendored/cached NLTK data, downloading only if allowed."""
+    import nltk
+
+    vendored = os.path.join(VENDOR_DIR, "nltk_data")
+    if os.path.isdir(vendored) and vendored not in nltk.data.path:
+        nltk.data.path.insert(0, vendored)
+    try:
+        nltk.data.find('tokenizers/punkt')
+        return True
+    except LookupError:
+        if NLTK_ALLOW_DOWNLOAD:
+            return nltk.download('punkt', quiet=True)
+        logging.warning("NLTK punkt data not found and NLTK_ALLOW_DOWNLOAD is off; run fetch_assets.py.")
+        return False
+
+
+def warmup(run_inference=True):
+    """Load the tokenizer, embedding model and NLTK data ahead of the first request.
+
+    With gunicorn --preload this runs once in the master with run_inference=False so the
+    weights are shared copy-on-write; workers then run a single inference each, which
+    keeps torch's thread pools out of the forked master.
+    """
+    global _warmed_up
+    started = time.perf_counter()
+    get_tokenizer()
+    model = get_embeddings()
+    ensure_nltk_data()
+    if run_inference:
+        model.embed_query("warmup")
+    _warmed_up = True
+    metrics.set_gauge("amverse_startup_seconds", time.perf_counter() - started, phase="warmup")
+    return time.perf_counter() - started
 
 custom_prompt_template = """
 Use the following pieces of retrieved context to answer the question.
@@ -91,6 +262,20 @@ Based on the following financial data, create a retirement plan that includes st
 Data: {customer_data}
 """
 
+def compile_user_prompt(validated_prompt):
+    """Turn a validated free-text prompt into a template string with {context} and {question}.
+
+    Any other braces the user typed are escaped so they can't break formatting, and the
+    retrieval placeholders are appended when the prompt doesn't place them itself.
+    """
+    template = validated_prompt.replace("{", "{{").replace("}", "}}")
+    template = template.replace("{{context}}", "{context}").replace("{{question}}", "{question}")
+    if "{context}" not in template:
+        template += "\n\nContext:\n{context}"
+    if "{question}" not in template:
+        template += "\n\nQuestion:\n{question}\n\nResponse:\n"
+    return template
+
 def set_user_prompt(user_prompt_template):
     prompt = PromptTemplate(template=user_prompt_template, input_variables=['context', 'question'])
     return prompt
@@ -129,21 +314,79 @@ def retrieval_qa_chain(llm, prompt, retriever):
         chain_type_kwargs={'prompt': prompt}
     )
 
-def load_llm():
-    llm = ChatOpenAI(model_name="gpt-4o", temperature=0)
+_llms = {}
+_llms_lock = threading.Lock()
+
+def load_llm(step="generate"):
+    """Return the chat model routed for `step`; one client is shared per tier."""
+    config = model_router.route(step)
+    key = (config["model"], config["max_tokens"], config["timeout"], config["max_retries"])
+    llm = _llms.get(key)
+    if llm is None:
+        with _llms_lock:
+            llm = _llms.get(key)
+            if llm is None:
+                llm = ChatOpenAI(
+                    model_name=config["model"],
+                    temperature=0,
+                    max_tokens=config["max_tokens"],
+                    timeout=config["timeout"],
+                    max_retries=config["max_retries"],
+                )
+                _llms[key] = llm
     return llm
 
-def qa_bot(index_name="public_index"):
-    pdf_db = ElasticsearchStore(
-        embedding=embeddings,
-        index_name=index_name,
-        es_cloud_id=os.environ["ES_CLOUD_ID"],
-        es_api_key=os.environ["ES_API_KEY"]
-    )
-    pdf_retriever = pdf_db.as_retriever(search_kwargs={'k': 5})
-
-    llm = load_llm()
-    qa_prompt = set_custom_prompt()
+def llm_text(response):
+    if hasattr(response, "content"):
+        return response.content
+    if isinstance(response, str):
+        return response
+    return None
+
+def invoke_llm(step, prompt):
+    """Invoke the model routed for `step`, recording the route, latency and token counts."""
+    llm = load_llm(step)
+    with stage("admission"):
+        admission.admit(model_router.route(step)["tier"])
+    started = time.perf_counter()
+    with stage(step):
+        response = llm.invoke(prompt)
+    model_router.record(step, model_router.route(step), time.perf_counter() - started)
+    count_llm_tokens(step, prompt, llm_text(response))
+    return response
+
+def count_llm_tokens(step, prompt, completion):
+    tokenizer = get_tokenizer()
+    metrics.record_tokens(step, len(tokenizer.encode(prompt)), len(tokenizer.encode(completion or "")))
+
+def run_qa_chain(chain, question, step="generate", retrieve_stage="retrieve"):
+    """Same as chain(question), but with retrieval and generation timed as separate stages."""
+    # Admit before retrieving so a shed request hasn't already paid for the search
+    with stage("admission"):
+        admission.admit(model_router.route(step)["tier"])
+    with stage(retrieve_stage):
+        docs = chain.retriever.invoke(question)
+    with stage("dedupe"):
+        docs = dedup.dedupe_retrieved(docs, k=RETRIEVAL_K)
+    started = time.perf_counter()
+    with stage(step):
+        answer = chain.combine_documents_chain.run(input_documents=docs, question=question)
+    model_router.record(step, model_router.route(step), time.perf_counter() - started)
+
+    # Rebuild the stuffed prompt the same way StuffDocumentsChain does, so the count matches what was sent
+    context_text = "\n\n".join(doc.page_content for doc in docs)
+    prompt = chain.combine_documents_chain.llm_chain.prompt.format(context=context_text, question=question)
+    count_llm_tokens(step, prompt, answer)
+    return {"result": answer, "source_documents": docs}
+
+def qa_bot(index_name="public_index", qa_prompt=None):
+    pdf_db = vector_store.get_vector_store(index_name, get_embeddings())
+    # Over-fetch so the near-duplicates run_qa_chain drops don't leave context slots empty
+    pdf_retriever = pdf_db.as_retriever(search_kwargs={'k': RETRIEVAL_FETCH_K})
+
+    llm = load_llm("generate")
+    if qa_prompt is None:
+        qa_prompt = set_custom_prompt()
     return retrieval_qa_chain(llm, qa_prompt, pdf_retriever)
 
 @app.route('/get_financial_assessment', methods=['POST'])
@@ -170,7 +413,8 @@ def get_financial_assessment():
         rebuilt_query = rebuild_query_with_llm(context, query)
 
         # Retrieve relevant documents
-        res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
+        with stage("retrieve"):
+            res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
         if not res:
             return jsonify({"response": "No relevant customer data found. Please contact the system administrator."}), 404
 
@@ -181,7 +425,7 @@ def get_financial_assessment():
             input_variables=['customer_data']
         )
         prompt = financial_assessment_prompt_template.format(customer_data=top_chunk)
-        result = chain(prompt)
+        result = run_qa_chain(chain, prompt, retrieve_stage="generate_retrieve")
         answer = result.get("result", "No assessment generated.")
 
         return jsonify({"response": answer})
@@ -190,6 +434,9 @@ def get_financial_assessment():
         # Handle case where the index does not exist
         return jsonify({"response": "No relevant customer data found in the system. Please contact the system administrator."}), 404
 
+    except admission.Overloaded:
+        raise
+
     except Exception as e:
         # Log unexpected errors for debugging
         logging.error(f"Unexpected error: {e}")
@@ -218,7 +465,8 @@ def get_goal_setting():
     rebuilt_query = rebuild_query_with_llm(context, query)
 
     # Retrieve relevant documents
-    res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
+    with stage("retrieve"):
+        res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
     if not res:
         return jsonify({"response": "No relevant financial goals data found."})
 
@@ -229,7 +477,7 @@ def get_goal_setting():
         input_variables=['customer_data']
     )
     prompt = goal_setting_prompt_template.format(customer_data=top_chunk)
-    result = chain(prompt)
+    result = run_qa_chain(chain, prompt, retrieve_stage="generate_retrieve")
     answer = result.get("result", "No goal setting generated.")
 
     return jsonify({"response": answer})
@@ -258,7 +506,8 @@ def get_tax_planning():
     rebuilt_query = rebuild_query_with_llm(context, query)
 
     # Retrieve relevant documents
-    res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
+    with stage("retrieve"):
+        res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
     if not res:
         return jsonify({"response": "No relevant tax planning data found."})
 
@@ -266,7 +515,7 @@ def get_tax_planning():
     top_chunk = res[0].page_content
     tax_prompt_template = set_tax_planning_prompt()
     prompt = tax_prompt_template.format(customer_data=top_chunk)
-    result = chain(prompt)
+    result = run_qa_chain(chain, prompt, retrieve_stage="generate_retrieve")
     answer = result.get("result", "No tax planning advice generated.")
 
     return jsonify({"response": answer})
@@ -295,7 +544,8 @@ def get_budgeting():
     rebuilt_query = rebuild_query_with_llm(context, query)
 
     # Retrieve relevant documents
-    res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
+    with stage("retrieve"):
+        res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
     if not res:
         return jsonify({"response": "No relevant budgeting data found."})
 
@@ -303,7 +553,7 @@ def get_budgeting():
     top_chunk = res[0].page_content
     budgeting_prompt_template = set_budgeting_prompt()
     prompt = budgeting_prompt_template.format(customer_data=top_chunk)
-    result = chain(prompt)
+    result = run_qa_chain(chain, prompt, retrieve_stage="generate_retrieve")
     answer = result.get("result", "No budgeting advice generated.")
 
     return jsonify({"response": answer})
@@ -332,7 +582,8 @@ def get_retirement_planning():
     rebuilt_query = rebuild_query_with_llm(context, query)
 
     # Retrieve relevant documents
-    res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
+    with stage("retrieve"):
+        res = chain.retriever.get_relevant_documents(f"{rebuilt_query} for {customer_name}")
     if not res:
         return jsonify({"response": "No relevant retirement data found."})
 
@@ -340,7 +591,7 @@ def get_retirement_planning():
     top_chunk = res[0].page_content
     retirement_prompt_template = set_retirement_planning_prompt()
     prompt = retirement_prompt_template.format(customer_data=top_chunk)
-    result = chain(prompt)
+    result = run_qa_chain(chain, prompt, retrieve_stage="generate_retrieve")
     answer = result.get("result", "No retirement planning advice generated.")
 
     return jsonify({"response": answer})
@@ -384,21 +635,33 @@ def rag_query():
         logging.warning(f"Rebuilt query is not a string: {rebuilt_query}")
         rebuilt_query = str(rebuilt_query)
 
+    # Identical questions arriving together share one retrieval and one set of LLM calls
+    answer, shared = admission.single_flight(
+        (index_name, admission.normalize_query(rebuilt_query)),
+        lambda: answer_public_query(index_name, rebuilt_query),
+    )
+    if shared:
+        logging.info(f"Reused in-flight answer for: {rebuilt_query}")
+
+    return jsonify({
+        "original_query": query,
+        "rebuilt_query": rebuilt_query,
+        "response": answer["response"],
+        "sources": answer["sources"]  # Include sources with screenshot URLs
+    })
+
+def answer_public_query(index_name, rebuilt_query):
+    """Steps 2-4 of /rag_query: answer from the index, then keep only the sources the answer used."""
     # Step 2: Get initial response and top 5 sources
     chain = qa_bot(index_name)
-    result = chain(rebuilt_query)
+    result = run_qa_chain(chain, rebuilt_query)
     response_text = result.get("result", "No response generated.")
     source_documents = result.get("source_documents", [])
 
     if not response_text.strip() or "I don't know" in response_text:
         # If no meaningful answer is provided, return an empty sources list
         logging.info("No meaningful response provided by GPT. No sources will be displayed.")
-        return jsonify({
-            "original_query": query,
-            "rebuilt_query": rebuilt_query,
-            "response": response_text,
-            "sources": []  # No sources are displayed
-        })
+        return {"response": response_text, "sources": []}  # No sources are displayed
 
     sources_summary = [
         f"- Source: {doc.metadata.get('source')}, Page: {doc.metadata.get('page_number')}, Screenshot URL: {doc.metadata.get('screenshot_url', 'N/A')}, Content: {doc.page_content}"
@@ -422,39 +685,36 @@ def rag_query():
     3. Verify that the page number and content align with the answer while ensuring the URLs remain unchanged.
     """
 
-    gpt_response = chain(reask_query)
-    used_sources_text = gpt_response.get("result", "")
+    # The sources are already in the prompt, so this goes straight to the (small) model
+    # rather than back through the retrieval chain
+    used_sources_text = llm_text(invoke_llm("attribute", reask_query)) or ""
 
     logging.info(f"The screenshot URLs: {used_sources_text}")
 
     # Step 4: Match sources explicitly mentioned by GPT
     used_sources = []
-    for doc in source_documents:
-        source_identifier = f"Source: {doc.metadata.get('source')}, Page: {doc.metadata.get('page_number')}, Screenshot URL: {doc.metadata.get('screenshot_url', 'N/A')}"
-        
-        # Normalize for comparison
-        normalized_used_sources_text = used_sources_text.lower().replace("\n", "").strip()
-        normalized_source_identifier = source_identifier.lower().strip()
-        
-        if normalized_source_identifier in normalized_used_sources_text:
-            used_sources.append({
-                "content": doc.page_content,
-                "metadata": {
-                    "source": doc.metadata.get("source"),
-                    "page_number": doc.metadata.get("page_number"),
-                    "screenshot_url": doc.metadata.get("screenshot_url")
-                }
-            })
+    with stage("match_sources"):
+        for doc in source_documents:
+            source_identifier = f"Source: {doc.metadata.get('source')}, Page: {doc.metadata.get('page_number')}, Screenshot URL: {doc.metadata.get('screenshot_url', 'N/A')}"
+
+            # Normalize for comparison
+            normalized_used_sources_text = used_sources_text.lower().replace("\n", "").strip()
+            normalized_source_identifier = source_identifier.lower().strip()
+
+            if normalized_source_identifier in normalized_used_sources_text:
+                used_sources.append({
+                    "content": doc.page_content,
+                    "metadata": {
+                        "source": doc.metadata.get("source"),
+                        "page_number": doc.metadata.get("page_number"),
+                        "screenshot_url": doc.metadata.get("screenshot_url")
+                    }
+                })
 
     # Log filtered sources for debugging
     logging.info(f"Filtered sources with screenshot URLs: {used_sources}")
 
-    return jsonify({
-        "original_query": query,
-        "rebuilt_query": rebuilt_query,
-        "response": response_text,
-        "sources": used_sources  # Include sources with screenshot URLs
-    })
+    return {"response": response_text, "sources": used_sources}
 
 def forward_request_to_endpoint(endpoint, data):
     """Helper function to forward request to another endpoint."""
@@ -474,8 +734,7 @@ def detect_unauthorized_query(query, user_name):
     If the query is about financial advice or the user's own financial data without mentioning another person's name, respond with "allowed".
     """
 
-    llm = load_llm()  # Load your GPT model
-    response = llm.invoke(prompt)
+    response = invoke_llm("guard", prompt)
 
     # Extract and return the response text
     if isinstance(response, str):
@@ -502,8 +761,7 @@ def rebuild_query_with_llm(history, current_query):
 
     Reconstructed Query:
     """
-    llm = load_llm()  
-    response = llm.invoke(llm_prompt) 
+    response = invoke_llm("rewrite", llm_prompt)
 
     if hasattr(response, "content"):  
         return response.content.strip()
@@ -517,8 +775,7 @@ def rebuild_query_with_llm(history, current_query):
 def gpt_query():
     data = request.json
     query = data.get('query', '')
-    llm = load_llm()  # Load GPT model only
-    result = llm.invoke(query)
+    result = invoke_llm("gpt_query", query)
     
     # Adjusting for possible AIMessage format
     response_text = result if isinstance(result, str) else getattr(result, "content", "No response generated.")
@@ -526,6 +783,10 @@ def gpt_query():
     print("GPT:", response_text)
     return jsonify({"query": query, "response": response_text})
 
+def repeated_line_key(line):
+    # Page numbers and dates change from page to page, so they shouldn't make a header look unique
+    return re.sub(r'\d+', '#', line.strip())
+
 def clean_text(text):
     text = text.encode('ascii', 'ignore').decode('ascii')
     text = re.sub(r'\s+', ' ', text).strip()
@@ -536,41 +797,46 @@ def detect_repeated_elements(text_list, position="start", threshold=0.5):
     for page_text in text_list:
         lines = page_text.split('\n')
         if position == "start" and lines:
-            first_line = lines[0].strip()
+            first_line = repeated_line_key(lines[0])
             if first_line:
                 element_count[first_line] += 1
         elif position == "end" and lines:
-            last_line = lines[-1].strip()
+            last_line = repeated_line_key(lines[-1])
             if last_line:
                 element_count[last_line] += 1
     total_pages = len(text_list)
-    return {line for line, count in element_count.items() if count / total_pages >= threshold}
+    # A line can't be a running header on a single page
+    if total_pages < 2:
+        return set()
+    return {line for line, count in element_count.items() if count >= 2 and count / total_pages >= threshold}
 
 def remove_headers_footers(text, headers, footers):
     lines = text.split('\n')
-    if lines and lines[0].strip() in headers:
+    if lines and repeated_line_key(lines[0]) in headers:
         lines = lines[1:]
-    if lines and lines[-1].strip() in footers:
+    if lines and repeated_line_key(lines[-1]) in footers:
         lines = lines[:-1]
     return '\n'.join(lines)
 
 def extract_pdf_content(pdf_path):
-    full_text = ""
-    page_texts = []
+    raw_pages = []
     with pdfplumber.open(pdf_path) as pdf:
         for page_number, page in enumerate(pdf.pages, start=1):
             text = page.extract_text()
             if text:
-                clean_page_text = clean_text(text)
-                page_texts.append((clean_page_text, page_number)) 
-    headers = detect_repeated_elements([text for text, _ in page_texts], position="start", threshold=0.5)
-    footers = detect_repeated_elements([text for text, _ in page_texts], position="end", threshold=0.5)
-    for page_text, _ in page_texts:
-        processed_text = remove_headers_footers(page_text, headers, footers)
-        full_text += processed_text + "\n"
+                raw_pages.append((text, page_number))
+    # Headers and footers are matched line by line, so strip them before clean_text collapses the newlines
+    headers = detect_repeated_elements([text for text, _ in raw_pages], position="start", threshold=0.5)
+    footers = detect_repeated_elements([text for text, _ in raw_pages], position="end", threshold=0.5)
+    page_texts = []
+    for text, page_number in raw_pages:
+        clean_page_text = clean_text(remove_headers_footers(text, headers, footers))
+        if clean_page_text:
+            page_texts.append((clean_page_text, page_number))
     return page_texts
 
 def split_by_tokens(text, max_tokens=4000):
+    tokenizer = get_tokenizer()
     tokens = tokenizer.encode(text)
     token_chunks = [tokens[i:i+max_tokens] for i in range(0, len(tokens), max_tokens)]
     return [tokenizer.decode(chunk) for chunk in token_chunks]
@@ -627,49 +893,103 @@ def process_chunks(chunks, metadata, tokenizer, max_tokens=4000):
 
     return processed_chunks
 
-def generate_screenshots(pdf_path, output_dir, pdf_filename):
-
-    doc = fitz.open(pdf_path)
-    screenshot_paths = []
+def page_screenshot_url(folder_prefix, pdf_filename, page_number):
+    return f"{PUBLIC_API_URL}/screenshots/{quote(folder_prefix)}/{quote(pdf_filename)}/{page_number}"
 
-    for page_number in range(len(doc)):
-        page = doc[page_number]
-        pix = page.get_pixmap()  
-        file_name = f"{os.path.splitext(pdf_filename)[0]}_page_{page_number + 1}.png"
-        screenshot_path = os.path.join(output_dir, file_name)
-        pix.save(screenshot_path)
-        screenshot_paths.append((screenshot_path, file_name))
-        logging.info(f"Generated screenshot for {pdf_filename}, page {page_number + 1}: {screenshot_path}")
+def upload_source_pdf(pdf_path, folder_prefix, pdf_filename):
+    """Store the source PDF once; page images are rendered from it on demand.
 
-    doc.close()
-    return screenshot_paths
-
-def upload_to_supabase(screenshot_paths, folder_prefix, pdf_filename):
+    Raises if the upload fails: without the source, the indexed chunks' screenshot links
+    would never resolve.
+    """
     supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-    screenshot_urls = []
-    folder_name = os.path.splitext(pdf_filename)[0] 
-    parent_folder = f"{folder_prefix}/{folder_name}"  
-
-    for path, file_name in screenshot_paths:  
+    bucket_file_path = f"{folder_prefix}/{pdf_filename}"
+    response = supabase.storage.from_(SOURCE_BUCKET).upload(
+        bucket_file_path, pdf_path, file_options={"content-type": "application/pdf", "upsert": "true"}
+    )
+    if not response or response.status_code != 200:
         try:
-            bucket_file_path = f"{parent_folder}/{file_name}"
-            response = supabase.storage.from_('screenshots').upload(bucket_file_path, path)
+            message = response.json().get('message', 'Unknown error')
+        except Exception:
+            message = getattr(response, "status_code", "no response")
+        raise RuntimeError(f"Failed to upload {bucket_file_path}: {message}")
+    logging.info(f"Uploaded source PDF {bucket_file_path}.")
 
-            if response and response.status_code == 200:
-                public_url = supabase.storage.from_('screenshots').get_public_url(bucket_file_path)
-                public_url = public_url.split('?')[0] 
-                screenshot_urls.append(public_url)
-                logging.info(f"Uploaded {file_name} successfully. URL: {public_url}")
-            else:
-                logging.error(f"Failed to upload {file_name}: {response.json().get('message', 'Unknown error')}")
-
-        except Exception as e:
-            logging.error(f"Exception occurred while uploading {file_name}: {e}")
-
-    return screenshot_urls
+def download_source_pdf(folder_prefix, pdf_filename):
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return supabase.storage.from_(SOURCE_BUCKET).download(f"{folder_prefix}/{pdf_filename}")
+
+def resolve_ingest_target(index_type, customer_name, private_name):
+    """Map the upload form fields to (index_name, folder_prefix)."""
+    if index_type == "Private":
+        if not private_name:
+            raise ValueError('Private name is required for Private indexing.')
+        sanitized_name = re.sub(r'[^\w\-]', '_', private_name).lower()
+        return f"{sanitized_name}_bank_info_index", f"{sanitized_name}_bank_info_screen"
+    elif index_type == "User":
+        sanitized_name = re.sub(r'[^\w\-]', '_', customer_name).lower()
+        return f"{sanitized_name}_user_index", f"{sanitized_name}_user_folder"
+    return f"{index_type.lower()}_index", f"{index_type.lower()}_folder"
+
+def prepare_pdf_documents(pdf_path, pdf_filename, folder_prefix):
+    """Parse one PDF into chunk Documents. Runs in the ingest process pool for batches."""
+    page_texts = extract_pdf_content(pdf_path)
+    screenshot_urls = [
+        page_screenshot_url(folder_prefix, pdf_filename, page_number)
+        for page_number in range(1, screenshots.page_count(pdf_path) + 1)
+    ]
+    chunks = []
+    for page_text, page_number in page_texts:
+        for chunk in improved_split_by_tokens(page_text, max_tokens=4000):
+            chunks.append((chunk, page_number))
+    documents = process_chunks(
+        chunks,
+        metadata={
+            "source": pdf_filename,
+            "screenshot_urls": screenshot_urls,
+        },
+        tokenizer=get_tokenizer()
+    )
+    return {"pages": len(page_texts), "documents": documents}
+
+def store_source_pdf(pdf_path, folder_prefix, pdf_filename):
+    # Pages are rendered lazily by /screenshots, so only the PDF itself is stored at ingest
+    upload_source_pdf(pdf_path, folder_prefix, pdf_filename)
+    screenshots.store_source(folder_prefix, pdf_filename, pdf_path)
+
+_ingest_pool = None
+_ingest_pool_lock = threading.Lock()
+
+def get_ingest_pool():
+    global _ingest_pool
+    if _ingest_pool is None:
+        with _ingest_pool_lock:
+            if _ingest_pool is None:
+                # Not fork: this process has torch threads and may hold locks in other threads,
+                # and a forked child would inherit them mid-use
+                method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+                context = multiprocessing.get_context(method)
+                if method == "forkserver":
+                    context.set_forkserver_preload([__name__])
+                _ingest_pool = ProcessPoolExecutor(max_workers=INGEST_WORKERS, mp_context=context)
+    return _ingest_pool
+
+def discard_ingest_pool(pool):
+    """Drop a pool left broken by a dead worker so the next get_ingest_pool() starts a fresh one."""
+    global _ingest_pool
+    with _ingest_pool_lock:
+        if _ingest_pool is pool:
+            _ingest_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def safe_pdf_filename(filename):
+    return os.path.basename(filename.replace("\\", "/")).strip()
 
 @app.route('/ingest_pdfs', methods=['POST'])
 def ingest_pdf():
+    # Checked before request.files parses (and spools) the body
+    if request.content_length is not None and request.content_length > INGEST_MAX_FILE_BYTES + INGEST_FORM_OVERHEAD_BYTES:
+        return jsonify({'success': False, 'message': f'File exceeds the {INGEST_MAX_FILE_BYTES} byte limit.'}), 413
     if 'file' not in request.files:
         return jsonify({'success': False, 'message': 'No file provided'}), 400
     file = request.files['file']
@@ -683,68 +1003,238 @@ def ingest_pdf():
         return jsonify({'success': False, 'message': 'Invalid file type. Please upload a PDF.'}), 400
 
     try:
-        if index_type == "Private":
-            if not private_name:
-                return jsonify({'success': False, 'message': 'Private name is required for Private indexing.'}), 400
-            sanitized_name = re.sub(r'[^\w\-]', '_', private_name).lower()
-            index_name = f"{sanitized_name}_bank_info_index"
-            folder_prefix = f"{sanitized_name}_bank_info_screen"
-        elif index_type == "User":
-            sanitized_name = re.sub(r'[^\w\-]', '_', customer_name).lower()
-            index_name = f"{sanitized_name}_user_index"
-            folder_prefix = f"{sanitized_name}_user_folder"
-        else:
-            index_name = f"{index_type.lower()}_index"
-            folder_prefix = f"{index_type.lower()}_folder"
+        index_name, folder_prefix = resolve_ingest_target(index_type, customer_name, private_name)
         logging.info(f"Indexing to {index_name} and storing screenshots in {folder_prefix}.")
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         logging.error(f"Error constructing index/folder names: {e}")
         return jsonify({'success': False, 'message': 'Error constructing index/folder names.', 'error': str(e)}), 500
 
-    temp_dir = tempfile.gettempdir()
-    temp_file_path = os.path.join(temp_dir, file.filename)
-    file.save(temp_file_path)
+    # A private scratch dir per request, so concurrent uploads with the same name don't collide
+    scratch_dir = tempfile.mkdtemp(prefix="amverse-ingest-")
+    filename = safe_pdf_filename(file.filename)
+    temp_file_path = os.path.join(scratch_dir, filename)
+    with stage("save_upload"):
+        file.save(temp_file_path)
+    # Chunked uploads carry no Content-Length, so check what actually arrived too
+    if os.path.getsize(temp_file_path) > INGEST_MAX_FILE_BYTES:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+        return jsonify({'success': False, 'message': f'File exceeds the {INGEST_MAX_FILE_BYTES} byte limit.'}), 413
 
     try:
-        page_texts = extract_pdf_content(temp_file_path)
-        screenshot_paths = generate_screenshots(temp_file_path, temp_dir, file.filename)
-        screenshot_urls = upload_to_supabase(screenshot_paths, folder_prefix, file.filename)
-        chunks = []
-        for page_text, page_number in page_texts:
-            page_chunks = improved_split_by_tokens(page_text, max_tokens=4000)
-            for chunk in page_chunks:
-                screenshot_url = screenshot_urls[page_number - 1] if len(screenshot_urls) >= page_number else None
-                if not screenshot_url:
-                    logging.error(f"Missing screenshot URL for page {page_number}")
-                chunks.append({
-                    "chunk": chunk,
-                    "page_number": page_number,
-                    "screenshot_url": screenshot_url,
-                })
-
-        all_chunks = process_chunks(
-            [(chunk["chunk"], chunk["page_number"]) for chunk in chunks],
-            metadata={
-                "source": file.filename,
-                "screenshot_urls": screenshot_urls,
-            },
-            tokenizer=tokenizer
-        )
-        db = ElasticsearchStore.from_documents(
-            all_chunks,
-            embedding=embeddings,
-            index_name=index_name,
-            es_cloud_id=os.environ["ES_CLOUD_ID"],
-            es_api_key=os.environ["ES_API_KEY"]
-        )
-        logging.info(f"PDF ingestion successful, {len(all_chunks)} documents indexed.")
-        return jsonify({"success": True, "message": "PDF ingestion complete.", "documents_indexed": len(all_chunks)})
+        with stage("extract"):
+            prepared = prepare_pdf_documents(temp_file_path, filename, folder_prefix)
+        try:
+            with stage("upload"):
+                store_source_pdf(temp_file_path, folder_prefix, filename)
+        except Exception as e:
+            # Nothing is indexed without its source, or the chunks' screenshot links would 404
+            logging.error(f"Error storing {filename}: {e}")
+            return jsonify({'success': False, 'message': 'Error storing file', 'error': str(e)}), 500
+        with stage("dedupe"):
+            all_chunks, duplicate_sources = dedup.unique_documents(index_name, prepared["documents"])
+        # Includes the `embed` stage, which is also recorded on its own
+        with stage("index"):
+            # A re-upload replaces the file's chunks; they go only once the new ones are in
+            previous_ids = vector_store.ids_by_metadata(index_name, "source", [filename])
+            if all_chunks:
+                vector_store.index_documents(all_chunks, get_embeddings(), index_name)
+            replaced = vector_store.delete_ids(index_name, previous_ids)
+        duplicates = len(prepared["documents"]) - len(all_chunks)
+        metrics.inc("amverse_ingested_pages_total", prepared["pages"])
+        metrics.inc("amverse_ingested_chunks_total", len(all_chunks))
+        logging.info(f"PDF ingestion successful, {len(all_chunks)} documents indexed, {replaced} replaced, {duplicates} near-duplicates skipped.")
+        return jsonify({
+            "success": True,
+            "message": "PDF ingestion complete.",
+            "documents_indexed": len(all_chunks),
+            "documents_replaced": replaced,
+            "duplicates_skipped": duplicates,
+            "duplicate_sources": duplicate_sources,
+        })
     except Exception as e:
         logging.error(f"Error processing file: {e}")
         return jsonify({'success': False, 'message': 'Error processing file', 'error': str(e)}), 500
     finally:
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+def collect_batch_uploads(scratch_dir):
+    """Save every uploaded PDF (and the PDFs inside any uploaded .zip) into scratch_dir.
+
+    Returns (saved, rejected): saved maps filename -> path, rejected is a list of per-file
+    error results.
+    """
+    saved = {}
+    rejected = []
+    total_bytes = 0
+
+    def add(filename, write, size=None):
+        """Save one PDF. `size` is the uncompressed size of a zip entry, checked before extracting."""
+        nonlocal total_bytes
+        filename = safe_pdf_filename(filename)
+        if not filename.lower().endswith('.pdf'):
+            rejected.append({"filename": filename, "success": False, "message": "Invalid file type. Please upload a PDF."})
+        elif filename in saved:
+            rejected.append({"filename": filename, "success": False, "message": "Duplicate file name in batch."})
+        elif len(saved) >= INGEST_BATCH_MAX_FILES:
+            rejected.append({"filename": filename, "success": False, "message": f"Batch limit of {INGEST_BATCH_MAX_FILES} files reached."})
+        elif size is not None and size > INGEST_MAX_FILE_BYTES:
+            rejected.append({"filename": filename, "success": False, "message": f"File exceeds the {INGEST_MAX_FILE_BYTES} byte limit."})
+        elif size is not None and total_bytes + size > INGEST_BATCH_MAX_BYTES:
+            rejected.append({"filename": filename, "success": False, "message": f"Batch size limit of {INGEST_BATCH_MAX_BYTES} bytes reached."})
+        else:
+            path = os.path.join(scratch_dir, filename)
+            write(path)
+            size = os.path.getsize(path)
+            if size > INGEST_MAX_FILE_BYTES or total_bytes + size > INGEST_BATCH_MAX_BYTES:
+                os.remove(path)
+                rejected.append({"filename": filename, "success": False, "message": "File exceeds the batch size limits."})
+                return
+            total_bytes += size
+            saved[filename] = path
+
+    for upload in request.files.getlist('files') + request.files.getlist('file'):
+        if not upload.filename:
+            continue
+        if upload.filename.lower().endswith('.zip'):
+            archive_path = os.path.join(scratch_dir, f".{uuid.uuid4().hex}.zip")
+            upload.save(archive_path)
+            try:
+                with zipfile.ZipFile(archive_path) as archive:
+                    for entry in archive.infolist():
+                        # Skip folders and macOS resource forks; names are flattened to their basename
+                        if entry.is_dir() or "__MACOSX" in entry.filename:
+                            continue
+
+                        # ZipExtFile never yields more than entry.file_size bytes, so checking the
+                        # declared size up front is enough to stop a zip bomb before it hits the disk
+                        def extract(path, entry=entry, archive=archive):
+                            with archive.open(entry) as src, open(path, "wb") as dst:
+                                shutil.copyfileobj(src, dst)
+                        add(entry.filename, extract, size=entry.file_size)
+            except zipfile.BadZipFile:
+                rejected.append({"filename": upload.filename, "success": False, "message": "Invalid zip archive."})
+            finally:
+                os.remove(archive_path)
+        else:
+            add(upload.filename, upload.save)
+    return saved, rejected
+
+@app.route('/ingest_pdfs_batch', methods=['POST'])
+def ingest_pdfs_batch():
+    """Ingest many PDFs (or zip archives of PDFs) into one index in a single request.
+
+    Parsing runs in a process pool; embedding and indexing are done once for the whole batch.
+    """
+    index_type = request.form.get('indexType', 'User').capitalize()
+    customer_name = request.form.get('customerName', '')
+    private_name = request.form.get('privateName', '').lower()
+
+    try:
+        index_name, folder_prefix = resolve_ingest_target(index_type, customer_name, private_name)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    scratch_dir = tempfile.mkdtemp(prefix="amverse-ingest-")
+    try:
+        with stage("save_upload"):
+            saved, results = collect_batch_uploads(scratch_dir)
+        if not saved:
+            return jsonify({'success': False, 'message': 'No PDF files provided', 'results': results}), 400
+        logging.info(f"Batch indexing {len(saved)} files to {index_name} and storing sources in {folder_prefix}.")
+
+        prepared = {}
+        with stage("extract"):
+            pool = get_ingest_pool()
+            futures = {}
+            for filename, path in saved.items():
+                try:
+                    futures[pool.submit(prepare_pdf_documents, path, filename, folder_prefix)] = filename
+                except BrokenProcessPool as e:
+                    discard_ingest_pool(pool)
+                    logging.error(f"Ingest pool unavailable for {filename}: {e}")
+                    results.append({"filename": filename, "success": False, "message": "Ingest worker unavailable, please retry", "error": str(e)})
+            for future in as_completed(futures):
+                filename = futures[future]
+                try:
+                    prepared[filename] = future.result()
+                except BrokenProcessPool as e:
+                    # A worker died (OOM, crash on a bad PDF); every file still in the pool fails with it
+                    discard_ingest_pool(pool)
+                    logging.error(f"Ingest worker died while processing {filename}: {e}")
+                    results.append({"filename": filename, "success": False, "message": "Ingest worker crashed, please retry", "error": str(e)})
+                except Exception as e:
+                    logging.error(f"Error processing {filename}: {e}")
+                    results.append({"filename": filename, "success": False, "message": "Error processing file", "error": str(e)})
+
+        def upload(filename):
+            try:
+                store_source_pdf(saved[filename], folder_prefix, filename)
+                return filename, None
+            except Exception as e:
+                return filename, e
+
+        with stage("upload"):
+            with ThreadPoolExecutor(max_workers=INGEST_UPLOAD_THREADS) as executor:
+                for filename, error in list(executor.map(upload, list(prepared))):
+                    if error is not None:
+                        logging.error(f"Error storing {filename}: {error}")
+                        results.append({"filename": filename, "success": False, "message": "Error storing file", "error": str(error)})
+                        del prepared[filename]
+
+        try:
+            with stage("dedupe"):
+                all_chunks, duplicate_sources = dedup.unique_documents(
+                    index_name, [doc for filename in prepared for doc in prepared[filename]["documents"]]
+                )
+        except Exception as e:
+            logging.error(f"Error checking batch for duplicates: {e}")
+            results.extend(
+                {"filename": filename, "success": False, "message": "Error indexing file", "error": str(e)}
+                for filename in prepared
+            )
+            return jsonify({'success': False, 'message': 'Error indexing batch', 'results': results}), 500
+        kept_ids = {id(doc) for doc in all_chunks}
+        try:
+            with stage("index"):
+                # Re-uploaded files replace their chunks; they go only once the new ones are in
+                previous_ids = vector_store.ids_by_metadata(index_name, "source", list(prepared))
+                if all_chunks:
+                    vector_store.index_documents(all_chunks, get_embeddings(), index_name)
+                replaced = vector_store.delete_ids(index_name, previous_ids)
+        except Exception as e:
+            logging.error(f"Error indexing batch: {e}")
+            results.extend(
+                {"filename": filename, "success": False, "message": "Error indexing file", "error": str(e)}
+                for filename in prepared
+            )
+            return jsonify({'success': False, 'message': 'Error indexing batch', 'results': results}), 500
+
+        for filename, item in prepared.items():
+            metrics.inc("amverse_ingested_pages_total", item["pages"])
+            indexed = sum(1 for doc in item["documents"] if id(doc) in kept_ids)
+            results.append({
+                "filename": filename,
+                "success": True,
+                "pages": item["pages"],
+                "documents_indexed": indexed,
+                "duplicates_skipped": len(item["documents"]) - indexed,
+            })
+        duplicates = sum(len(item["documents"]) for item in prepared.values()) - len(all_chunks)
+        metrics.inc("amverse_ingested_chunks_total", len(all_chunks))
+        logging.info(f"Batch ingestion complete: {len(prepared)} files, {len(all_chunks)} documents indexed, {replaced} replaced, {duplicates} near-duplicates skipped.")
+        return jsonify({
+            "success": bool(prepared),
+            "message": f"Ingested {len(prepared)} of {len(saved)} files.",
+            "documents_indexed": len(all_chunks),
+            "documents_replaced": replaced,
+            "duplicates_skipped": duplicates,
+            "duplicate_sources": duplicate_sources,
+            "results": results,
+        })
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
 
 @app.route('/delete_previous_file', methods=['POST'])
 def delete_previous_file():
@@ -762,36 +1252,62 @@ def delete_previous_file():
     folder_prefix = f"{sanitized_name}_user_folder"
 
     try:
-        es_client = Elasticsearch(
-            cloud_id=os.environ["ES_CLOUD_ID"],
-            api_key=os.environ["ES_API_KEY"]
-        )
-        if es_client.indices.exists(index=index_name):
-            es_client.indices.delete(index=index_name)
-            logging.info(f"Deleted Elasticsearch index: {index_name}")
+        if vector_store.delete_index(index_name):
+            logging.info(f"Deleted {vector_store.VECTOR_STORE_BACKEND} index: {index_name}")
         else:
-            logging.info(f"Elasticsearch index not found: {index_name}")
+            logging.info(f"{vector_store.VECTOR_STORE_BACKEND} index not found: {index_name}")
     except Exception as e:
-        logging.error(f"Error with Elasticsearch: {e}")
-        return jsonify({'success': False, 'message': 'Error with Elasticsearch', 'error': str(e)}), 500
+        logging.error(f"Error with vector store: {e}")
+        return jsonify({'success': False, 'message': 'Error with vector store', 'error': str(e)}), 500
 
     # Attempt to delete files in Supabase
     try:
         supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-        folder_files = supabase.storage.from_('screenshots').list(folder_prefix)
+        folder_files = supabase.storage.from_(SOURCE_BUCKET).list(folder_prefix)
         if folder_files and isinstance(folder_files, list):
             file_paths = [f"{folder_prefix}/{file['name']}" for file in folder_files]
-            response = supabase.storage.from_('screenshots').remove(file_paths)
+            response = supabase.storage.from_(SOURCE_BUCKET).remove(file_paths)
             if 'error' in response and response['error']:
                 logging.error(f"Error deleting Supabase files: {response['error']['message']}")
                 return jsonify({'success': False, 'message': 'Error deleting files'}), 500
             logging.info(f"Deleted Supabase folder: {folder_prefix}")
+        screenshots.invalidate(folder_prefix)
     except Exception as e:
         logging.error(f"Error with Supabase: {e}")
         return jsonify({'success': False, 'message': 'Error with Supabase', 'error': str(e)}), 500
 
     return jsonify({'success': True, 'message': 'Deleted User index and folder.'})
 
+@app.route('/screenshots/<folder_prefix>/<pdf_filename>/<int:page_number>', methods=['GET'])
+def get_screenshot(folder_prefix, pdf_filename, page_number):
+    try:
+        dpi, fmt, thumb = screenshots.parse_options(
+            request.args.get('dpi'), request.args.get('format'), request.args.get('thumb')
+        )
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    try:
+        with stage("fetch_source"):
+            pdf_path, source_hit = screenshots.cached_source(
+                folder_prefix, pdf_filename, lambda: download_source_pdf(folder_prefix, pdf_filename)
+            )
+        metrics.record_cache("screenshot_source", source_hit)
+        with stage("render"):
+            image, mimetype, render_hit = screenshots.get_page_image(
+                folder_prefix, pdf_filename, page_number, pdf_path, dpi, fmt, thumb
+            )
+        metrics.record_cache("screenshot_render", render_hit)
+    except IndexError as e:
+        return jsonify({'success': False, 'message': str(e)}), 404
+    except Exception as e:
+        logging.error(f"Error rendering {folder_prefix}/{pdf_filename} page {page_number}: {e}")
+        return jsonify({'success': False, 'message': 'Screenshot not available'}), 404
+
+    response = Response(image, mimetype=mimetype)
+    response.headers['Cache-Control'] = f"public, max-age={SCREENSHOT_BROWSER_MAX_AGE}"
+    return response
+
 @app.route('/rag_query_custom', methods=['POST'])
 def rag_query_custom():
     data = request.json
@@ -800,12 +1316,20 @@ def rag_query_custom():
     customer_name = data.get('customer_name', '').lower()
     user_prompt = data.get('customPrompt', '') 
 
-    validated_prompt = validate_and_redefine_prompt(user_prompt)
-    set_user_prompt(validated_prompt)  
-
     sanitized_name = re.sub(r'[^\w\-]', '_', customer_name).lower()
     index_name = f"{sanitized_name}_user_index"
 
+    # Validation is an LLM call, so it only happens when this user's prompt text changes
+    qa_prompt = None
+    if user_prompt.strip():
+        qa_prompt, prompt_hit = prompt_cache.get_prompt(
+            sanitized_name,
+            user_prompt,
+            lambda text: compile_user_prompt(validate_and_redefine_prompt(text)),
+            set_user_prompt,
+        )
+        metrics.record_cache("custom_prompt", prompt_hit)
+
     # Step 1: Rebuild query with LLM
     rebuilt_query = rebuild_query_with_llm(context, query)
     if not isinstance(rebuilt_query, str):
@@ -813,8 +1337,8 @@ def rag_query_custom():
         rebuilt_query = str(rebuilt_query)
 
     # Step 2: Get initial response and top 5 sources
-    chain = qa_bot(index_name)
-    result = chain(rebuilt_query)
+    chain = qa_bot(index_name, qa_prompt)
+    result = run_qa_chain(chain, rebuilt_query)
     response_text = result.get("result", "No response generated.")
     source_documents = result.get("source_documents", [])
 
@@ -849,22 +1373,24 @@ def rag_query_custom():
     Ensure the page number is accurate and verify the information aligns with the answer.
     """
 
-    gpt_response = chain(reask_query)
-    used_sources_text = gpt_response.get("result", "")
+    # The sources are already in the prompt, so this goes straight to the (small) model
+    # rather than back through the retrieval chain
+    used_sources_text = llm_text(invoke_llm("attribute", reask_query)) or ""
 
     # Step 4: Match sources explicitly mentioned by GPT
     used_sources = []
-    for doc in source_documents:
-        source_identifier = f"Source: {doc.metadata.get('source')}, Page: {doc.metadata.get('page_number')}, Screenshot URL: {doc.metadata.get('screenshot_url', 'N/A')}"
-        if source_identifier in used_sources_text:
-            used_sources.append({
-                "content": doc.page_content,
-                "metadata": {
-                    "source": doc.metadata.get("source"),
-                    "page_number": doc.metadata.get("page_number"),
-                    "screenshot_url": doc.metadata.get("screenshot_url")  # Include screenshot URL
-                }
-            })
+    with stage("match_sources"):
+        for doc in source_documents:
+            source_identifier = f"Source: {doc.metadata.get('source')}, Page: {doc.metadata.get('page_number')}, Screenshot URL: {doc.metadata.get('screenshot_url', 'N/A')}"
+            if source_identifier in used_sources_text:
+                used_sources.append({
+                    "content": doc.page_content,
+                    "metadata": {
+                        "source": doc.metadata.get("source"),
+                        "page_number": doc.metadata.get("page_number"),
+                        "screenshot_url": doc.metadata.get("screenshot_url")  # Include screenshot URL
+                    }
+                })
 
     # Log filtered sources for debugging
     logging.info(f"Filtered sources with screenshot URLs: {used_sources}")
@@ -885,8 +1411,7 @@ def validate_and_redefine_prompt(prompt):
     
     If it is unclear, rewrite the prompt to make it clear and specific. Otherwise, return the original prompt. Only return the improved prompt or the original prompt.
     """
-    llm = load_llm()  # Load GPT model
-    response = llm.invoke(validation_prompt)
+    response = invoke_llm("validate_prompt", validation_prompt)
 
     # Extract the plain content from the response
     if hasattr(response, "content"):  # Check if response has 'content' attribute
@@ -897,5 +1422,17 @@ def validate_and_redefine_prompt(prompt):
         logging.error(f"Unexpected LLM response format: {response}")
         return prompt  # Fallback to the original prompt
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    metrics.set_gauge("amverse_process_rss_bytes", metrics.process_rss_bytes())
+    return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok", "warmed_up": _warmed_up})
+
+metrics.set_gauge("amverse_startup_seconds", time.perf_counter() - APP_IMPORT_STARTED, phase="import")
+
 if __name__ == '__main__':
+    warmup()
     app.run(debug=False)
@@ -0,0 +1,192 @@
+"""Deterministic local stand-ins for OpenAI and Supabase storage."""
+import hashlib
+import json
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def _send(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server:
+    handler_class = None
+
+    def __init__(self, **handler_attrs):
+        handler = type(self.handler_class.__name__, (self.handler_class,), handler_attrs)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def fake_completion(prompt):
+    """Answer the app's prompt shapes deterministically so the full pipeline is exercised."""
+    if 'respond with "allowed"' in prompt:
+        return "allowed"
+    if "Reconstructed Query:" in prompt:
+        match = re.search(r"New Query:\s*(.*?)\s*Reconstructed Query:", prompt, re.S)
+        return match.group(1).strip() if match else prompt.strip().splitlines()[-1]
+    if "Screenshot URL: [screenshot_url]" in prompt:
+        # Citation reask: claim the first two sources listed in the prompt
+        cited = re.findall(r"- (Source: .*?, Page: .*?, Screenshot URL: \S*?), Content:", prompt)
+        return "\n".join(f"- {line}" for line in cited[:2])
+    if "Evaluate the following prompt" in prompt:
+        match = re.search(r"Prompt:\s*(.*?)\s*If it is unclear", prompt, re.S)
+        return match.group(1).strip() if match else prompt
+    digest = hashlib.sha256(prompt.encode()).hexdigest()
+    return f"Based on the statement records, the balance summary is {int(digest[:6], 16) % 10000}.00 (ref {digest[:12]})."
+
+
+class _OpenAIHandler(_QuietHandler):
+    latency_s = 0.0
+
+    def do_POST(self):
+        payload = json.loads(self._read_body() or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+        prompt = "\n".join(
+            message["content"] if isinstance(message.get("content"), str) else json.dumps(message.get("content"))
+            for message in payload.get("messages", [])
+        )
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        content = fake_completion(prompt)
+        self._send(200, {
+            "id": "chatcmpl-" + hashlib.sha1(prompt.encode()).hexdigest()[:24],
+            "object": "chat.completion",
+            "created": 0,
+            "model": payload.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": {
+                "prompt_tokens": len(prompt.split()),
+                "completion_tokens": len(content.split()),
+                "total_tokens": len(prompt.split()) + len(content.split()),
+            },
+        })
+
+
+class FakeOpenAIServer(_Server):
+    """Serves /v1/chat/completions with canned answers after `latency_ms` of simulated thinking."""
+    handler_class = _OpenAIHandler
+
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_s=latency_ms / 1000.0)
+
+    @property
+    def base_url(self):
+        return f"{self.url}/v1"
+
+
+def _multipart_file(content_type, body):
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    for part in message.iter_parts():
+        if part.get_filename() is not None or part.get_param("name", header="content-disposition") == "file":
+            return part.get_payload(decode=True)
+    return body
+
+
+class _StorageHandler(_QuietHandler):
+    objects = None
+    lock = None
+
+    def _object_path(self, prefix):
+        path = unquote(urlparse(self.path).path)
+        return path[len(prefix):] if path.startswith(prefix) else None
+
+    def do_POST(self):
+        body = self._read_body()
+        list_bucket = self._object_path("/storage/v1/object/list/")
+        if list_bucket is not None:
+            options = json.loads(body or b"{}")
+            prefix = f"{list_bucket.strip('/')}/{options.get('prefix', '').strip('/')}/"
+            with self.lock:
+                names = sorted({key[len(prefix):].split("/")[0] for key in self.objects if key.startswith(prefix)})
+            return self._send(200, [{"name": name, "id": name, "metadata": {}} for name in names])
+
+        key = self._object_path("/storage/v1/object/")
+        if key is None:
+            return self._send(404, {"message": "not found"})
+        content_type = self.headers.get("Content-Type", "")
+        data = _multipart_file(content_type, body) if content_type.startswith("multipart/") else body
+        with self.lock:
+            self.objects[key] = data
+        self._send(200, {"Key": key})
+
+    def do_PUT(self):
+        self.do_POST()
+
+    def do_GET(self):
+        key = self._object_path("/storage/v1/object/public/")
+        if key is None:
+            key = self._object_path("/storage/v1/object/authenticated/")
+        if key is None:
+            key = self._object_path("/storage/v1/object/")
+        with self.lock:
+            data = self.objects.get(key) if key else None
+        if data is None:
+            return self._send(404, {"message": "Object not found", "statusCode": "404", "error": "not_found"})
+        self._send(200, data, content_type="application/octet-stream")
+
+    def do_DELETE(self):
+        bucket = self._object_path("/storage/v1/object/")
+        prefixes = json.loads(self._read_body() or b"{}").get("prefixes", [])
+        removed = []
+        with self.lock:
+            for prefix in prefixes:
+                key = f"{bucket.strip('/')}/{prefix}"
+                if self.objects.pop(key, None) is not None:
+                    removed.append({"name": prefix})
+        self._send(200, removed)
+
+
+class FakeSupabaseServer(_Server):
+    """Just enough of the Supabase storage REST API for upload, download, list and remove."""
+    handler_class = _StorageHandler
+    # create_client() only accepts JWT-shaped keys
+    api_key = "bench.fake.key"
+
+    def __init__(self):
+        self.objects = {}
+        super().__init__(objects=self.objects, lock=threading.Lock())
+
@@ -0,0 +1,78 @@
+"""Synthetic multi-page bank statements for the benchmark suite."""
+import os
+import random
+
+import fitz
+
+MERCHANTS = [
+    "GROCERY MART", "CITY TRANSIT", "ELECTRIC CO", "COFFEE HOUSE", "ONLINE BOOKS",
+    "FUEL STATION", "PHARMACY PLUS", "STREAMING SVC", "PAYROLL DEPOSIT", "RENT PAYMENT",
+    "INSURANCE PREMIUM", "ATM WITHDRAWAL", "RESTAURANT", "HARDWARE STORE", "GYM MEMBERSHIP",
+]
+
+LINES_PER_PAGE = 38
+
+NOTICES = [
+    "IMPORTANT NOTICES",
+    "Please examine this statement carefully and notify the bank of any discrepancy within",
+    "21 days from the statement date, failing which the entries shall be deemed correct.",
+    "Cheques deposited are subject to clearance. The bank reserves the right to debit the",
+    "account for any returned or dishonoured items, together with applicable charges.",
+    "Interest on overdrawn balances is charged daily at the prevailing rate published in",
+    "branches and on the bank's website. Fees and charges are subject to change with 21 days",
+    "prior notice in accordance with the bank's terms and conditions for deposit accounts.",
+    "For enquiries, please call the customer contact centre or visit any branch.",
+]
+
+
+def generate_statement(path, customer, pages, seed):
+    """Write a statement of `pages` pages with a repeated header/footer and random transactions.
+
+    The last page is the same notices boilerplate in every statement, so near-duplicate
+    detection has something to find.
+    """
+    rng = random.Random(seed)
+    balance = rng.randint(1000, 20000) + rng.random()
+    doc = fitz.open()
+    for page_number in range(1, pages + 1):
+        page = doc.new_page(width=595, height=842)
+        if page_number == pages and pages > 1:
+            y = 40
+            for line in NOTICES:
+                page.insert_text((40, y), line, fontsize=9)
+                y += 16
+            page.insert_text((40, y + 8), f"Statement for {customer}.", fontsize=9)
+            continue
+        y = 40
+        page.insert_text((40, y), "AMVERSE BANK BERHAD - STATEMENT OF ACCOUNT", fontsize=11)
+        y += 18
+        page.insert_text((40, y), f"Account holder: {customer}    Account no: {seed:010d}", fontsize=9)
+        y += 24
+        page.insert_text((40, y), "Date        Description                      Amount        Balance", fontsize=9)
+        y += 16
+        for _ in range(LINES_PER_PAGE):
+            amount = round(rng.uniform(-450, 300), 2)
+            balance += amount
+            day = rng.randint(1, 28)
+            month = rng.randint(1, 12)
+            description = rng.choice(MERCHANTS)
+            page.insert_text(
+                (40, y),
+                f"{day:02d}/{month:02d}/2024  {description:<32} {amount:>10.2f}  {balance:>12.2f}",
+                fontsize=9,
+            )
+            y += 17
+        page.insert_text((40, 815), f"Page {page_number} of {pages} - Member of PIDM. Protected by PIDM up to RM250,000 for each depositor.", fontsize=7)
+    doc.save(path)
+    doc.close()
+    return path
+
+
+def generate_corpus(output_dir, count, pages, seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(output_dir, f"statement_{seed}_{i:03d}.pdf")
+        generate_statement(path, f"Customer {i:03d}", pages, seed * 1000 + i)
+        paths.append(path)
+    return paths
@@ -0,0 +1,335 @@
+"""Offline benchmark for the ingest and RAG pipelines.
+
+Runs backend/app.py in-process against local stand-ins: a deterministic fake OpenAI
+server, a fake Supabase storage server and either the local vector store (in a temporary
+directory) or a local Elasticsearch container. Nothing leaves the machine.
+
+    cd backend
+    python -m bench.run --pdfs 8 --pages 6 --queries 200 --concurrency 1,4,16 --output results.json
+    python -m bench.run --compare results.json --output new.json
+
+To benchmark against a real Elasticsearch instead of the local vector store:
+
+    docker run -d -p 9200:9200 -e discovery.type=single-node -e xpack.security.enabled=false \\
+        docker.elastic.co/elasticsearch/elasticsearch:8.15.1
+    python -m bench.run --es-url http://localhost:9200
+
+The tiktoken encoding and, without --fake-embeddings, the mpnet model must already be
+in the local caches.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.fakes import FakeOpenAIServer, FakeSupabaseServer
+from bench.pdfgen import generate_corpus
+
+QUERIES = [
+    "what is my closing balance",
+    "how much did i spend on groceries",
+    "list the largest withdrawals",
+    "what was the payroll deposit amount",
+    "how much did i pay for rent",
+    "which month had the highest spending",
+    "what fees were charged to my account",
+    "summarise my transport spending",
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile; `values` need not be sorted."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize_latencies(latencies, elapsed):
+    if not latencies:
+        return {"requests": 0, "p50_ms": None, "p90_ms": None, "p99_ms": None, "mean_ms": None, "max_ms": None, "throughput_rps": 0}
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+    }
+
+
+def stage_summary(snapshot):
+    stages = {}
+    for series in snapshot["histograms"].get("amverse_stage_seconds", []):
+        labels = series["labels"]
+        if not series["count"]:
+            continue
+        stages[f"{labels['pipeline']}.{labels['stage']}"] = {
+            "count": series["count"],
+            "mean_ms": round(series["sum"] / series["count"] * 1000, 3),
+            "total_s": round(series["sum"], 4),
+        }
+    return dict(sorted(stages.items()))
+
+
+def token_summary(snapshot):
+    tokens = {}
+    for series in snapshot["counters"].get("amverse_llm_tokens_total", []):
+        labels = series["labels"]
+        tokens.setdefault(labels["step"], {})[labels["kind"]] = series["value"]
+    return dict(sorted(tokens.items()))
+
+
+def route_summary(snapshot):
+    """Model each step was routed to, with its call count and mean latency."""
+    routes = {}
+    for series in snapshot["histograms"].get("amverse_llm_seconds", []):
+        labels = series["labels"]
+        if not series["count"]:
+            continue
+        routes[labels["step"]] = {
+            "model": labels["model"],
+            "count": series["count"],
+            "mean_ms": round(series["sum"] / series["count"] * 1000, 3),
+        }
+    return dict(sorted(routes.items()))
+
+
+def admission_summary(snapshot):
+    """Admitted/rejected LLM calls per tier and how many /rag_query answers were coalesced."""
+    summary = {}
+    for series in snapshot["counters"].get("amverse_admission_total", []):
+        labels = series["labels"]
+        summary.setdefault(labels["tier"], {})[labels["result"]] = series["value"]
+    for series in snapshot["counters"].get("amverse_singleflight_total", []):
+        summary.setdefault("singleflight", {})[series["labels"]["result"]] = series["value"]
+    return dict(sorted(summary.items()))
+
+
+def dedup_summary(snapshot):
+    """Chunks kept and skipped at ingest, texts embedded, and the duplicate-context rate at retrieval."""
+    def counts(name):
+        return {series["labels"].get("result", series["labels"].get("kind")): series["value"] for series in snapshot["counters"].get(name, [])}
+
+    ingest = counts("amverse_dedup_chunks_total")
+    retrieved = counts("amverse_retrieved_chunks_total")
+    considered = retrieved.get("kept", 0) + retrieved.get("duplicate", 0)
+    return {
+        "chunks_kept": ingest.get("kept", 0),
+        "chunks_skipped": ingest.get("duplicate", 0),
+        "texts_embedded": counts("amverse_embedded_texts_total"),
+        "duplicate_context_rate": round(retrieved.get("duplicate", 0) / considered, 4) if considered else None,
+    }
+
+
+def git_version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def configure_environment(openai_server, supabase_server, args, scratch_dir):
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-bench",
+        "OPENAI_API_BASE": openai_server.base_url,
+        "SUPABASE_URL": supabase_server.url,
+        "SUPABASE_KEY": supabase_server.api_key,
+        "LANGCHAIN_API_KEY": "bench",
+        "LANGCHAIN_TRACING_V2": "false",
+        "ES_CLOUD_ID": "bench:bench",
+        "ES_API_KEY": "bench",
+        "TRACE_FILE": "",
+        "HF_HUB_OFFLINE": "1",
+        # 0 disables admission control so latency numbers aren't capped by the bucket
+        "LLM_RATE_SMALL": str(args.llm_rate),
+        "LLM_RATE_LARGE": str(args.llm_rate),
+        # Fresh caches per run, so warm entries from the server or earlier runs don't skew hit ratios
+        "SCREENSHOT_CACHE_DIR": os.path.join(scratch_dir, "render_cache"),
+        "PROMPT_CACHE_DIR": os.path.join(scratch_dir, "prompt_cache"),
+    })
+    if args.es_url:
+        os.environ["ES_URL"] = args.es_url
+        os.environ["VECTOR_STORE_BACKEND"] = "elasticsearch"
+    else:
+        os.environ["VECTOR_STORE_BACKEND"] = "local"
+        os.environ["LOCAL_VECTOR_STORE_DIR"] = os.path.join(scratch_dir, "vectors")
+        os.environ["LOCAL_VECTOR_DTYPE"] = args.vector_dtype
+
+
+def load_app(args):
+    import app as app_module
+    import metrics
+
+    if args.fake_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        app_module.set_embeddings(DeterministicFakeEmbedding(size=768))
+    return app_module, metrics
+
+
+def run_ingest(app_module, paths):
+    client = app_module.app.test_client()
+    per_file = []
+    start = time.perf_counter()
+    for path in paths:
+        file_start = time.perf_counter()
+        with open(path, "rb") as f:
+            response = client.post(
+                "/ingest_pdfs",
+                data={"file": (f, os.path.basename(path)), "indexType": "Public"},
+                content_type="multipart/form-data",
+            )
+        body = response.get_json() or {}
+        if response.status_code != 200 or not body.get("success"):
+            raise RuntimeError(f"Ingest of {path} failed: {response.status_code} {body}")
+        per_file.append(time.perf_counter() - file_start)
+    elapsed = time.perf_counter() - start
+    return elapsed, per_file
+
+
+def run_queries(app_module, total, concurrency):
+    def worker(indices):
+        client = app_module.app.test_client()
+        latencies = []
+        shed = 0
+        for i in indices:
+            query_start = time.perf_counter()
+            response = client.post("/rag_query", json={"query": QUERIES[i % len(QUERIES)], "context": ""})
+            if response.status_code == 503:
+                shed += 1
+                continue
+            if response.status_code != 200:
+                raise RuntimeError(f"/rag_query failed: {response.status_code} {response.get_data(as_text=True)[:200]}")
+            latencies.append(time.perf_counter() - query_start)
+        return latencies, shed
+
+    batches = [list(range(i, total, concurrency)) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(worker, batches))
+    latencies = [latency for batch, _ in outcomes for latency in batch]
+    summary = summarize_latencies(latencies, time.perf_counter() - start)
+    summary["shed"] = sum(shed for _, shed in outcomes)
+    return summary
+
+
+def compare(previous, current):
+    """Print relative changes of the headline numbers between two result files."""
+    def delta(old, new, higher_is_better=False):
+        if not old or new is None:
+            return "n/a"
+        change = (new - old) / old * 100
+        better = change > 0 if higher_is_better else change < 0
+        return f"{old:>10.2f} -> {new:>10.2f}  ({change:+.1f}%{' better' if better else ''})"
+
+    print(f"Comparing {previous.get('version')} -> {current.get('version')}")
+    print(f"  ingest pages/s      {delta(previous['ingest']['pages_per_second'], current['ingest']['pages_per_second'], True)}")
+    for level, result in current["query"].items():
+        old = previous["query"].get(level)
+        if not old:
+            continue
+        print(f"  c={level:<4} p50 ms      {delta(old['p50_ms'], result['p50_ms'])}")
+        print(f"  c={level:<4} p99 ms      {delta(old['p99_ms'], result['p99_ms'])}")
+        print(f"  c={level:<4} rps         {delta(old['throughput_rps'], result['throughput_rps'], True)}")
+    for name, result in current["stages"].items():
+        old = previous["stages"].get(name)
+        if old:
+            print(f"  {name:<40} mean ms {delta(old['mean_ms'], result['mean_ms'])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pdfs", type=int, default=4, help="Number of synthetic statements to ingest")
+    parser.add_argument("--pages", type=int, default=5, help="Pages per statement")
+    parser.add_argument("--queries", type=int, default=100, help="/rag_query calls per concurrency level")
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels")
+    parser.add_argument("--llm-latency-ms", type=float, default=50, help="Simulated latency of each fake LLM call")
+    parser.add_argument("--llm-rate", type=float, default=0, help="LLM calls/s per tier admitted by the token bucket (0 = unlimited)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--es-url", help="Use this Elasticsearch instead of the local vector store")
+    parser.add_argument("--vector-dtype", choices=["float32", "int8"], default="float32", help="Local vector store precision")
+    parser.add_argument("--fake-embeddings", action="store_true", help="Hash-based embeddings instead of mpnet")
+    parser.add_argument("--output", help="Write results as JSON to this path")
+    parser.add_argument("--compare", help="Previous results JSON to compare against")
+    args = parser.parse_args(argv)
+
+    openai_server = FakeOpenAIServer(latency_ms=args.llm_latency_ms).start()
+    supabase_server = FakeSupabaseServer().start()
+    scratch = tempfile.TemporaryDirectory(prefix="amverse-bench-")
+    configure_environment(openai_server, supabase_server, args, scratch.name)
+
+    try:
+        import_start = time.perf_counter()
+        app_module, metrics = load_app(args)
+        import_seconds = time.perf_counter() - import_start
+        warmup_seconds = app_module.warmup()
+
+        paths = generate_corpus(os.path.join(scratch.name, "corpus"), args.pdfs, args.pages, seed=args.seed)
+        metrics.reset()
+        ingest_seconds, per_file = run_ingest(app_module, paths)
+        ingest_snapshot = metrics.snapshot()
+
+        total_pages = args.pdfs * args.pages
+        results = {
+            "version": git_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "config": vars(args),
+            "startup": {
+                "import_seconds": round(import_seconds, 3),
+                "warmup_seconds": round(warmup_seconds, 3),
+                "rss_bytes": metrics.process_rss_bytes(),
+            },
+            "ingest": {
+                "files": len(per_file),
+                "pages": total_pages,
+                "seconds": round(ingest_seconds, 3),
+                "pages_per_second": round(total_pages / ingest_seconds, 2),
+                "per_file_p50_ms": round(percentile(per_file, 50) * 1000, 2),
+                "stages": stage_summary(ingest_snapshot),
+                "dedup": dedup_summary(ingest_snapshot),
+                "index_chunks": app_module.vector_store.index_size("public_index"),
+            },
+            "query": {},
+        }
+
+        metrics.reset()
+        for level in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+            results["query"][str(level)] = run_queries(app_module, args.queries, level)
+            print(f"concurrency={level}: {results['query'][str(level)]}", file=sys.stderr)
+        query_snapshot = metrics.snapshot()
+        results["stages"] = stage_summary(query_snapshot)
+        results["tokens"] = token_summary(query_snapshot)
+        results["routes"] = route_summary(query_snapshot)
+        results["admission"] = admission_summary(query_snapshot)
+        results["retrieval_dedup"] = dedup_summary(query_snapshot)["duplicate_context_rate"]
+    finally:
+        openai_server.stop()
+        supabase_server.stop()
+        scratch.cleanup()
+
+    output = json.dumps(results, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+"""Near-duplicate chunk detection with MinHash signatures and LSH banding.
+
+At ingest every chunk gets a MinHash signature over its word 5-shingles, stored in its own
+metadata along with one LSH key per band, so the signatures live (and are deleted) with
+the index on whichever backend holds it. New chunks are looked up by band key, and one
+whose estimated Jaccard similarity to a stored chunk, or to an earlier chunk in the same
+upload, reaches DEDUP_THRESHOLD is not embedded or indexed. Stored chunks of a source being
+uploaded again are left out of the comparison: the ingest endpoints replace them with the
+new upload's chunks.
+
+Indices created before signatures were stored can be brought up to date with
+
+    python -m dedup --backfill public_index
+
+At query time dedupe_retrieved() drops retrieved chunks that nearly repeat a higher-ranked
+one, so boilerplate can't take several of the context slots.
+"""
+import argparse
+import hashlib
+import logging
+import os
+import re
+
+import numpy as np
+
+import metrics
+import vector_store
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "1") == "1"
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.85"))
+DEDUP_RETRIEVAL_THRESHOLD = float(os.getenv("DEDUP_RETRIEVAL_THRESHOLD", "0.8"))
+
+SHINGLE_WORDS = 5
+NUM_PERM = 128
+# 16 bands of 8 rows make pairs above ~0.7 similarity likely candidates; DEDUP_THRESHOLD decides
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SIGNATURE_FIELD = "minhash"
+BANDS_FIELD = "lsh_bands"
+
+_MERSENNE = (1 << 61) - 1
+# Fixed seed: stored signatures are only comparable if every process uses the same permutations
+_rng = np.random.RandomState(20240901)
+_A = _rng.randint(1, 1 << 31, NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, NUM_PERM).astype(np.uint64)
+_EMPTY = np.full(NUM_PERM, 0xFFFFFFFF, dtype=np.uint32)
+
+
+def shingles(text):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= SHINGLE_WORDS:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def signature(text):
+    shingle_set = shingles(text)
+    if not shingle_set:
+        return _EMPTY.copy()
+    hashes = np.fromiter(
+        (int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little") for s in shingle_set),
+        dtype=np.uint64,
+        count=len(shingle_set),
+    )
+    # 32-bit hashes times 31-bit multipliers stay below 2**63, so uint64 can't overflow
+    permuted = (np.outer(hashes, _A) + _B) % _MERSENNE
+    return (permuted & 0xFFFFFFFF).min(axis=0).astype(np.uint32)
+
+
+def band_keys(sig):
+    return [
+        f"{band}-{hashlib.blake2b(sig[band * ROWS:(band + 1) * ROWS].tobytes(), digest_size=8).hexdigest()}"
+        for band in range(BANDS)
+    ]
+
+
+def signature_metadata(text):
+    """The metadata fields that let later ingests find this chunk."""
+    sig = signature(text)
+    return {SIGNATURE_FIELD: sig.tobytes().hex(), BANDS_FIELD: band_keys(sig)}
+
+
+def _stored_signature(metadata):
+    return np.frombuffer(bytes.fromhex(metadata[SIGNATURE_FIELD]), dtype=np.uint32)
+
+
+class LSHIndex:
+    """Banded MinHash index answering "is there a stored signature at least this similar?"."""
+
+    def __init__(self):
+        self.signatures = []
+        self.metadata = []
+        self.buckets = {}
+
+    def add(self, sig, metadata, keys=None):
+        row = len(self.signatures)
+        self.signatures.append(sig)
+        self.metadata.append(metadata)
+        for key in keys or band_keys(sig):
+            self.buckets.setdefault(key, []).append(row)
+        return row
+
+    def best_match(self, sig, threshold, keys=None):
+        """Return (metadata, similarity) of the closest signature at or above threshold, or None."""
+        candidates = set()
+        for key in keys or band_keys(sig):
+            candidates.update(self.buckets.get(key, ()))
+        best = None
+        for row in candidates:
+            similarity = float(np.mean(self.signatures[row] == sig))
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (self.metadata[row], similarity)
+        return best
+
+
+def unique_documents(index_name, documents):
+    """Return (kept, duplicate_sources) for documents about to be indexed into index_name.
+
+    Every document gets its signature metadata, kept or not. A document is dropped when it
+    nearly repeats a chunk already in the index, or an earlier document in this call (so
+    boilerplate repeated within one file is kept once); duplicate_sources names the sources
+    it repeated. Stored chunks of the documents' own sources are ignored, since the caller
+    replaces them. Two ingests racing into the
+    same index can both keep the same chunk; dedupe_retrieved() covers that at query time.
+    """
+    documents = list(documents)
+    if not DEDUP_ENABLED or not documents:
+        return documents, []
+
+    for doc in documents:
+        doc.metadata.update(signature_metadata(doc.page_content))
+    lsh = LSHIndex()
+    replacing = {doc.metadata.get("source") for doc in documents}
+    wanted = {key for doc in documents for key in doc.metadata[BANDS_FIELD]}
+    for stored in vector_store.find_by_metadata(index_name, BANDS_FIELD, wanted):
+        if SIGNATURE_FIELD in stored and stored.get("source") not in replacing:
+            lsh.add(_stored_signature(stored), stored, stored.get(BANDS_FIELD))
+
+    kept, duplicate_sources = [], set()
+    for doc in documents:
+        sig = _stored_signature(doc.metadata)
+        keys = doc.metadata[BANDS_FIELD]
+        match = lsh.best_match(sig, DEDUP_THRESHOLD, keys=keys)
+        if match is not None:
+            original, similarity = match
+            duplicate_sources.add(original.get("source"))
+            logging.debug(f"Skipping {doc.metadata.get('index')}: near-duplicate of {original.get('index')} ({similarity:.2f})")
+            continue
+        lsh.add(sig, doc.metadata, keys)
+        kept.append(doc)
+
+    metrics.inc("amverse_dedup_chunks_total", len(kept), result="kept")
+    metrics.inc("amverse_dedup_chunks_total", len(documents) - len(kept), result="duplicate")
+    logging.info(f"{index_name}: {len(documents) - len(kept)} of {len(documents)} chunks were near-duplicates.")
+    return kept, sorted(source for source in duplicate_sources if source)
+
+
+def backfill(index_name):
+    """Add signature metadata to chunks indexed before it was stored. Returns how many were updated."""
+    return vector_store.backfill_metadata(index_name, SIGNATURE_FIELD, signature_metadata)
+
+
+def dedupe_retrieved(documents, k=None, threshold=None):
+    """Drop retrieved chunks that nearly repeat a higher-ranked one, keeping at most k."""
+    threshold = DEDUP_RETRIEVAL_THRESHOLD if threshold is None else threshold
+    kept, kept_shingles, duplicates = [], [], 0
+    for doc in documents:
+        if k is not None and len(kept) >= k:
+            break
+        shingle_set = shingles(doc.page_content)
+        if any(jaccard(shingle_set, other) >= threshold for other in kept_shingles):
+            duplicates += 1
+            continue
+        kept.append(doc)
+        kept_shingles.append(shingle_set)
+    metrics.inc("amverse_retrieved_chunks_total", len(kept), result="kept")
+    metrics.inc("amverse_retrieved_chunks_total", duplicates, result="duplicate")
+    return kept
+
+
+metrics.describe("amverse_dedup_chunks_total", "Ingested chunks kept or skipped as near-duplicates of the index.")
+metrics.describe("amverse_retrieved_chunks_total", "Retrieved chunks passed to the prompt (kept) or dropped as near-duplicates.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Near-duplicate signature maintenance")
+    parser.add_argument("--backfill", nargs="+", metavar="INDEX", required=True, help="Indices to add missing signatures to")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for name in args.backfill:
+        print(f"{name}: {backfill(name)} chunks updated")
@@ -0,0 +1,29 @@
+"""Download the NLTK data, tiktoken encoding and embedding model for offline startup.
+
+Run once on a machine with network access; copy backend/vendor and the Hugging Face
+cache (or set HF_HOME to a shipped directory) to the air-gapped host, then start with
+HF_HUB_OFFLINE=1.
+"""
+import os
+
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor")
+
+
+def main():
+    tiktoken_dir = os.path.join(VENDOR_DIR, "tiktoken")
+    nltk_dir = os.path.join(VENDOR_DIR, "nltk_data")
+    os.makedirs(tiktoken_dir, exist_ok=True)
+    os.environ["TIKTOKEN_CACHE_DIR"] = tiktoken_dir
+
+    import nltk
+    import tiktoken
+    from sentence_transformers import SentenceTransformer
+
+    nltk.download("punkt", download_dir=nltk_dir)
+    tiktoken.get_encoding("cl100k_base")
+    SentenceTransformer(os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-mpnet-base-v2"))
+    print(f"Assets stored under {VENDOR_DIR} and the Hugging Face cache.")
+
+
+if __name__ == "__main__":
+    main()
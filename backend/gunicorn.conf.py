@@ -0,0 +1,65 @@
+# gunicorn -c gunicorn.conf.py app:app
+import gc
+import logging
+import os
+import shutil
+import time
+
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# LLM token buckets live in each worker; tell admission.py how many ways to split the rate
+os.environ.setdefault("LLM_ADMISSION_WORKERS", str(workers))
+# Each worker keeps its own metrics; they meet in this directory so /metrics can report them all
+os.environ.setdefault(
+    "METRICS_MULTIPROC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "metrics")
+)
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# Load app.py (and, through warmup, the embedding weights) once in the master so that
+# forked workers share those pages copy-on-write instead of each loading their own copy
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
+
+def on_starting(server):
+    # Counters from a previous run of the server would otherwise be added to this one's
+    shutil.rmtree(os.environ["METRICS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["METRICS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import app
+    import metrics
+
+    started = time.perf_counter()
+    app.warmup(run_inference=False)
+    # Move everything loaded so far out of the collector's reach; otherwise gc passes in
+    # the workers touch the shared objects and un-share their pages
+    gc.freeze()
+    memory = metrics.process_memory()
+    server.log.info(
+        f"Master warmed up in {time.perf_counter() - started:.2f}s "
+        f"(import {time.perf_counter() - app.APP_IMPORT_STARTED:.2f}s total), RSS {memory['rss'] / 2**20:.0f} MiB"
+    )
+
+
+def post_worker_init(worker):
+    import app
+    import metrics
+
+    warmup_seconds = app.warmup()
+    memory = metrics.process_memory()
+    pss = f", PSS {memory['pss'] / 2**20:.0f} MiB" if "pss" in memory else ""
+    worker.log.info(
+        f"Worker {worker.pid} ready: warmup {warmup_seconds:.2f}s, RSS {memory['rss'] / 2**20:.0f} MiB{pss}"
+    )
+    metrics.set_gauge("amverse_process_rss_bytes", memory["rss"])
+    metrics.start_flusher()
+
+
+def worker_exit(server, worker):
+    import metrics
+
+    # Keep the exiting worker's final counts in the merged totals
+    metrics.flush()
@@ -0,0 +1,326 @@
+"""In-process metrics registry with a Prometheus text renderer.
+
+Under gunicorn every worker has its own registry. Set METRICS_MULTIPROC_DIR (gunicorn.conf.py
+does) and each worker writes its series to <dir>/<pid>.json every METRICS_FLUSH_SECONDS and
+on exit; /metrics then merges all the files, so whichever worker answers the scrape reports
+the whole server. Counters and histograms of exited workers keep counting towards the
+totals, so they never appear to reset; gauges are per process and carry a `pid` label.
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import tracing
+
+# Bucket upper bounds in seconds. LLM calls routinely take several seconds, so the
+# range is wider than the Prometheus client default.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_help = {}
+
+METRICS_MULTIPROC_DIR = os.getenv("METRICS_MULTIPROC_DIR", "")
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "5"))
+_flusher = None
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(label_key, extra=None):
+    pairs = list(label_key) + list(extra or [])
+    if not pairs:
+        return ""
+    escaped = [
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def describe(name, help_text):
+    _help[name] = help_text
+
+
+def observe(name, value, **labels):
+    """Record a single observation into the histogram `name`."""
+    key = _label_key(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        state = series.get(key)
+        if state is None:
+            state = {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0}
+            series[key] = state
+        for i, bound in enumerate(DEFAULT_BUCKETS):
+            if value <= bound:
+                state["buckets"][i] += 1
+        state["sum"] += value
+        state["count"] += 1
+
+
+def inc(name, amount=1, **labels):
+    key = _label_key(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def set_gauge(name, value, **labels):
+    key = _label_key(labels)
+    with _lock:
+        _gauges.setdefault(name, {})[key] = value
+
+
+@contextmanager
+def track_stage(pipeline, stage):
+    """Time the wrapped block into the `amverse_stage_seconds` histogram and the request trace."""
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        with tracing.span(stage):
+            yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        observe("amverse_stage_seconds", time.perf_counter() - start, pipeline=pipeline, stage=stage)
+        if status == "error":
+            inc("amverse_stage_errors_total", pipeline=pipeline, stage=stage)
+
+
+def record_tokens(step, prompt_tokens, completion_tokens):
+    inc("amverse_llm_tokens_total", prompt_tokens, step=step, kind="prompt")
+    inc("amverse_llm_tokens_total", completion_tokens, step=step, kind="completion")
+    inc("amverse_llm_calls_total", step=step)
+
+
+def record_cache(cache, hit):
+    inc("amverse_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def process_memory():
+    """Resident and proportional set size of this process in bytes (PSS is Linux-only).
+
+    PSS splits shared pages between the processes mapping them, so it shows how much a
+    gunicorn worker really costs once model weights are shared with the master.
+    """
+    memory = {}
+    for path, fields in (("/proc/self/status", {"VmRSS:": "rss"}), ("/proc/self/smaps_rollup", {"Pss:": "pss"})):
+        try:
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    if parts and parts[0] in fields:
+                        memory[fields[parts[0]]] = int(parts[1]) * 1024
+        except OSError:
+            continue
+    if "rss" not in memory:
+        import resource
+        # Peak rather than current RSS, but the best available without /proc; bytes on macOS, KiB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        memory["rss"] = peak if sys.platform == "darwin" else peak * 1024
+    return memory
+
+
+def process_rss_bytes():
+    return process_memory()["rss"]
+
+
+def snapshot():
+    """Return a plain-dict copy of every series."""
+    with _lock:
+        histograms = {
+            name: [
+                {"labels": dict(key), "count": state["count"], "sum": state["sum"]}
+                for key, state in series.items()
+            ]
+            for name, series in _histograms.items()
+        }
+        counters = {
+            name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+            for name, series in _counters.items()
+        }
+        gauges = {
+            name: [{"labels": dict(key), "value": value} for key, value in series.items()]
+            for name, series in _gauges.items()
+        }
+    return {"histograms": histograms, "counters": counters, "gauges": gauges}
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+def _hit_ratios(counters):
+    totals = {}
+    for key, value in counters.get("amverse_cache_requests_total", {}).items():
+        labels = dict(key)
+        hits, total = totals.get(labels["cache"], (0, 0))
+        if labels["result"] == "hit":
+            hits += value
+        totals[labels["cache"]] = (hits, total + value)
+    return {cache: hits / total if total else 0.0 for cache, (hits, total) in totals.items()}
+
+
+def cache_hit_ratios():
+    with _lock:
+        counters = {"amverse_cache_requests_total": dict(_counters.get("amverse_cache_requests_total", {}))}
+    return _hit_ratios(counters)
+
+
+def _dump():
+    """Write this process's series to METRICS_MULTIPROC_DIR/<pid>.json."""
+    with _lock:
+        state = {
+            "histograms": {name: [[list(key), state] for key, state in series.items()] for name, series in _histograms.items()},
+            "counters": {name: [[list(key), value] for key, value in series.items()] for name, series in _counters.items()},
+            "gauges": {name: [[list(key), value] for key, value in series.items()] for name, series in _gauges.items()},
+        }
+        data = json.dumps(state)
+    os.makedirs(METRICS_MULTIPROC_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=METRICS_MULTIPROC_DIR, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        f.write(data)
+    os.replace(tmp_path, os.path.join(METRICS_MULTIPROC_DIR, f"{os.getpid()}.json"))
+
+
+def flush():
+    if METRICS_MULTIPROC_DIR:
+        _dump()
+
+
+def start_flusher():
+    """Periodically write this process's series for the other workers' /metrics to merge."""
+    global _flusher
+    if not METRICS_MULTIPROC_DIR or (_flusher is not None and _flusher.is_alive()):
+        return
+
+    def loop():
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                _dump()
+            except OSError:
+                pass
+
+    _flusher = threading.Thread(target=loop, name="metrics-flusher", daemon=True)
+    _flusher.start()
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merged():
+    """Sum counters and histograms over every process's dump; keep gauges of live processes only."""
+    _dump()
+    histograms, counters, gauges = {}, {}, {}
+    for name in os.listdir(METRICS_MULTIPROC_DIR):
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(METRICS_MULTIPROC_DIR, name)) as f:
+                state = json.load(f)
+            pid = int(name[:-len(".json")])
+        except (OSError, ValueError):
+            continue
+        for metric, series in state["histograms"].items():
+            merged = histograms.setdefault(metric, {})
+            for key, value in series:
+                key = tuple(tuple(pair) for pair in key)
+                total = merged.setdefault(key, {"buckets": [0] * len(DEFAULT_BUCKETS), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], value["buckets"])]
+                total["sum"] += value["sum"]
+                total["count"] += value["count"]
+        for metric, series in state["counters"].items():
+            merged = counters.setdefault(metric, {})
+            for key, value in series:
+                key = tuple(tuple(pair) for pair in key)
+                merged[key] = merged.get(key, 0) + value
+        if _pid_alive(pid):
+            for metric, series in state["gauges"].items():
+                merged = gauges.setdefault(metric, {})
+                for key, value in series:
+                    merged[tuple(sorted([tuple(pair) for pair in key] + [("pid", str(pid))]))] = value
+    return histograms, counters, gauges
+
+
+def _render(histograms, counters, gauges):
+    lines = []
+    for name in sorted(histograms):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, state in sorted(histograms[name].items()):
+            for bound, count in zip(DEFAULT_BUCKETS, state["buckets"]):
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', _format_value(bound))])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(key, [('le', '+Inf')])} {state['count']}")
+            lines.append(f"{name}_sum{_format_labels(key)} {_format_value(state['sum'])}")
+            lines.append(f"{name}_count{_format_labels(key)} {state['count']}")
+    for name in sorted(counters):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for key, value in sorted(counters[name].items()):
+            lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+    for name in sorted(gauges):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} gauge")
+        for key, value in sorted(gauges[name].items()):
+            lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def render_prometheus():
+    """Render every series in the Prometheus text exposition format (0.0.4)."""
+    if METRICS_MULTIPROC_DIR:
+        histograms, counters, gauges = _merged()
+        # Ratios come from the merged counters, so they are server-wide rather than per pid
+        gauges["amverse_cache_hit_ratio"] = {
+            _label_key({"cache": cache}): ratio for cache, ratio in _hit_ratios(counters).items()
+        }
+        return _render(histograms, counters, gauges)
+
+    for cache, ratio in cache_hit_ratios().items():
+        set_gauge("amverse_cache_hit_ratio", ratio, cache=cache)
+    with _lock:
+        return _render(_histograms, _counters, _gauges)
+
+
+describe("amverse_stage_seconds", "Wall-clock time spent in each pipeline stage.")
+describe("amverse_stage_errors_total", "Pipeline stages that raised an exception.")
+describe("amverse_llm_tokens_total", "Prompt and completion tokens per LLM step, counted with tiktoken cl100k_base.")
+describe("amverse_llm_calls_total", "LLM invocations per pipeline step.")
+describe("amverse_cache_requests_total", "Cache lookups by cache name and result.")
+describe("amverse_cache_hit_ratio", "Hit ratio per cache since the server started.")
+describe("amverse_ingested_pages_total", "PDF pages with extractable text ingested.")
+describe("amverse_ingested_chunks_total", "Chunks written to the vector store at ingest.")
+describe("amverse_embedded_texts_total", "Texts sent to the embedding model, by document (ingest) or query.")
+describe("amverse_startup_seconds", "Seconds spent importing the app and warming up its models.")
+describe("amverse_process_rss_bytes", "Resident set size of the serving process.")
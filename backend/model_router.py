@@ -0,0 +1,56 @@
+"""Map each pipeline step to a model tier.
+
+Short classification and rewriting steps don't need the flagship model, so they default
+to the small tier; answers shown to the user stay on the large one. Every tier's model,
+token limit and timeout, and every step's tier, can be overridden from the environment:
+
+    MODEL_TIER_SMALL=gpt-4o-mini  MODEL_TIER_SMALL_MAX_TOKENS=512  MODEL_TIER_SMALL_TIMEOUT=20
+    MODEL_ROUTE_REWRITE=large
+"""
+import os
+
+import metrics
+
+
+def _tier(name, model, max_tokens, timeout):
+    prefix = f"MODEL_TIER_{name.upper()}"
+    max_tokens = os.getenv(f"{prefix}_MAX_TOKENS", max_tokens)
+    return {
+        "tier": name,
+        "model": os.getenv(prefix, model),
+        "max_tokens": int(max_tokens) if max_tokens else None,
+        "timeout": float(os.getenv(f"{prefix}_TIMEOUT", timeout)),
+        "max_retries": int(os.getenv(f"{prefix}_MAX_RETRIES", "2")),
+    }
+
+
+TIERS = {
+    "small": _tier("small", "gpt-4o-mini", "512", "20"),
+    "large": _tier("large", "gpt-4o", "", "60"),
+}
+
+DEFAULT_STEP_TIERS = {
+    "guard": "small",
+    "rewrite": "small",
+    "attribute": "small",
+    "validate_prompt": "small",
+    "generate": "large",
+    "gpt_query": "large",
+}
+
+
+def route(step):
+    """Return the tier config for a pipeline step; unknown steps go to the large tier."""
+    tier = os.getenv(f"MODEL_ROUTE_{step.upper()}", DEFAULT_STEP_TIERS.get(step, "large")).lower()
+    if tier not in TIERS:
+        tier = "large"
+    return TIERS[tier]
+
+
+def record(step, config, seconds):
+    metrics.inc("amverse_llm_route_total", step=step, tier=config["tier"], model=config["model"])
+    metrics.observe("amverse_llm_seconds", seconds, step=step, model=config["model"])
+
+
+metrics.describe("amverse_llm_route_total", "LLM calls per pipeline step and the tier/model they were routed to.")
+metrics.describe("amverse_llm_seconds", "LLM call latency per pipeline step and model.")
@@ -0,0 +1,109 @@
+"""Cache of validated custom prompts, in memory and persisted per user.
+
+Validating a custom prompt costs an LLM round-trip, but a user's prompt rarely changes
+between messages. Entries are keyed by user and a hash of the raw prompt text, so editing
+the prompt misses and replaces the old entry.
+"""
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+PROMPT_CACHE_DIR = os.getenv(
+    "PROMPT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_cache")
+)
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "1024"))
+# How many distinct prompts to remember per user; 1 means a new prompt replaces the old one
+PROMPT_CACHE_PER_USER = int(os.getenv("PROMPT_CACHE_PER_USER", "1"))
+
+_memory = OrderedDict()
+_lock = threading.Lock()
+_key_locks = {}
+
+
+def prompt_digest(prompt_text):
+    return hashlib.sha256(prompt_text.strip().encode("utf-8")).hexdigest()
+
+
+def _user_file(user_key):
+    safe_user = re.sub(r'[^\w\-]', '_', user_key).lower() or "_anonymous"
+    return os.path.join(PROMPT_CACHE_DIR, f"{safe_user}.json")
+
+
+def _load_user_entries(user_key):
+    try:
+        with open(_user_file(user_key)) as f:
+            return json.load(f).get("entries", [])
+    except (FileNotFoundError, ValueError):
+        return []
+
+
+def _save_user_entries(user_key, entries):
+    path = _user_file(user_key)
+    os.makedirs(PROMPT_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=PROMPT_CACHE_DIR, prefix=".tmp-")
+    with os.fdopen(fd, "w") as f:
+        json.dump({"entries": entries}, f)
+    os.replace(tmp_path, path)
+
+
+def _remember(key, value):
+    with _lock:
+        _memory[key] = value
+        _memory.move_to_end(key)
+        while len(_memory) > PROMPT_CACHE_SIZE:
+            _memory.popitem(last=False)
+
+
+def get_prompt(user_key, prompt_text, compile_template, build_prompt):
+    """Return (prompt, hit) for a user's custom prompt.
+
+    compile_template(prompt_text) produces the template string on a miss (the expensive,
+    LLM-backed step); build_prompt(template) turns a template string into the object the
+    chain uses. Only template strings are written to disk.
+    """
+    digest = prompt_digest(prompt_text)
+    key = (user_key, digest)
+    with _lock:
+        if key in _memory:
+            _memory.move_to_end(key)
+            return _memory[key], True
+        key_lock = _key_locks.setdefault(key, threading.Lock())
+
+    # Concurrent misses for the same prompt wait for one compile instead of each paying for it
+    with key_lock:
+        try:
+            return _load_or_compile(user_key, prompt_text, key, compile_template, build_prompt)
+        finally:
+            with _lock:
+                _key_locks.pop(key, None)
+
+
+def _load_or_compile(user_key, prompt_text, key, compile_template, build_prompt):
+    digest = key[1]
+    with _lock:
+        if key in _memory:
+            return _memory[key], True
+
+    entries = _load_user_entries(user_key)
+    for entry in entries:
+        if entry["digest"] == digest:
+            prompt = build_prompt(entry["template"])
+            _remember(key, prompt)
+            return prompt, True
+
+    template = compile_template(prompt_text)
+    prompt = build_prompt(template)
+    entries = ([{"digest": digest, "template": template}] + entries)[:PROMPT_CACHE_PER_USER]
+    kept = {entry["digest"] for entry in entries}
+    _save_user_entries(user_key, entries)
+    with _lock:
+        # Drop in-memory copies of prompts this user has since replaced
+        for cached_user, cached_digest in [k for k in _memory if k[0] == user_key]:
+            if cached_digest not in kept:
+                _memory.pop((cached_user, cached_digest), None)
+    _remember(key, prompt)
+    return prompt, False
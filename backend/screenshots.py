@@ -0,0 +1,213 @@
+"""On-demand page rendering with an LRU disk cache.
+
+Ingestion stores each source PDF once; pages are rendered the first time somebody opens
+a cited screenshot and kept under SCREENSHOT_CACHE_DIR until the cache grows past
+SCREENSHOT_CACHE_MAX_BYTES, at which point the least recently served files go first.
+"""
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import fitz
+
+SCREENSHOT_CACHE_DIR = os.getenv(
+    "SCREENSHOT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_cache")
+)
+SCREENSHOT_CACHE_MAX_BYTES = int(os.getenv("SCREENSHOT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+SCREENSHOT_DPI = int(os.getenv("SCREENSHOT_DPI", "72"))
+SCREENSHOT_FORMAT = os.getenv("SCREENSHOT_FORMAT", "png").lower()
+# Longest edge in pixels for thumbnails requested without an explicit size
+SCREENSHOT_THUMB_SIZE = int(os.getenv("SCREENSHOT_THUMB_SIZE", "320"))
+SCREENSHOT_JPEG_QUALITY = int(os.getenv("SCREENSHOT_JPEG_QUALITY", "85"))
+
+MIN_DPI = 36
+MAX_DPI = 300
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "webp": ("WEBP", "image/webp"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "jpg": ("JPEG", "image/jpeg"),
+}
+
+_lock = threading.Lock()
+_cache_bytes = None
+
+
+def _safe_component(value):
+    cleaned = re.sub(r'[^\w\-. ]', '_', value).strip()
+    if not cleaned or cleaned in (".", ".."):
+        raise ValueError(f"Invalid path component: {value!r}")
+    return cleaned
+
+
+def source_path(folder_prefix, pdf_filename):
+    return os.path.join(SCREENSHOT_CACHE_DIR, "sources", _safe_component(folder_prefix), _safe_component(pdf_filename))
+
+
+def _pages_dir(folder_prefix, pdf_filename):
+    return os.path.join(SCREENSHOT_CACHE_DIR, "pages", _safe_component(folder_prefix), _safe_component(pdf_filename))
+
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _iter_cache_files():
+    for root, _, files in os.walk(SCREENSHOT_CACHE_DIR):
+        for name in files:
+            if not name.startswith(".tmp-"):
+                yield os.path.join(root, name)
+
+
+def _account(delta):
+    """Track the cache size, evicting least recently used files when it exceeds the limit."""
+    global _cache_bytes
+    with _lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(os.path.getsize(path) for path in _iter_cache_files())
+        else:
+            _cache_bytes += delta
+        if _cache_bytes <= SCREENSHOT_CACHE_MAX_BYTES:
+            return
+        entries = []
+        for path in _iter_cache_files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # Rendered pages are cheap to redo, so they go before any source PDF does
+            is_source = path.startswith(os.path.join(SCREENSHOT_CACHE_DIR, "sources") + os.sep)
+            entries.append((is_source, stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, _, size, _ in entries)
+        # Evict down to 90% so a full cache doesn't rescan on every insert
+        target = SCREENSHOT_CACHE_MAX_BYTES * 0.9
+        for _, _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        _cache_bytes = total
+
+
+def _touch(path):
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def store_source(folder_prefix, pdf_filename, local_pdf_path):
+    """Keep a local copy of an ingested PDF so its first render needs no download."""
+    path = source_path(folder_prefix, pdf_filename)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    previous = os.path.getsize(path) if os.path.exists(path) else 0
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    os.close(fd)
+    shutil.copyfile(local_pdf_path, tmp_path)
+    os.replace(tmp_path, path)
+    invalidate(folder_prefix, pdf_filename)
+    _account(os.path.getsize(path) - previous)
+    return path
+
+
+def cached_source(folder_prefix, pdf_filename, fetch):
+    """Return (path, hit) for the source PDF, calling fetch() for its bytes on a miss."""
+    path = source_path(folder_prefix, pdf_filename)
+    if os.path.exists(path):
+        _touch(path)
+        return path, True
+    data = fetch()
+    _write_atomic(path, data)
+    _account(len(data))
+    return path, False
+
+
+def invalidate(folder_prefix, pdf_filename=None):
+    """Drop rendered pages (and, for a whole folder, the cached sources) after a re-ingest or delete."""
+    if pdf_filename is None:
+        targets = [
+            os.path.join(SCREENSHOT_CACHE_DIR, "pages", _safe_component(folder_prefix)),
+            os.path.join(SCREENSHOT_CACHE_DIR, "sources", _safe_component(folder_prefix)),
+        ]
+    else:
+        targets = [_pages_dir(folder_prefix, pdf_filename)]
+    removed = 0
+    for target in targets:
+        if os.path.isdir(target):
+            removed += sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(target) for name in files)
+            shutil.rmtree(target, ignore_errors=True)
+    if removed:
+        _account(-removed)
+
+
+def parse_options(dpi=None, fmt=None, thumb=None):
+    """Validate request options, falling back to the configured defaults."""
+    fmt = (fmt or SCREENSHOT_FORMAT).lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"Unsupported format {fmt!r}; use one of {', '.join(sorted(FORMATS))}.")
+    dpi = min(max(int(dpi or SCREENSHOT_DPI), MIN_DPI), MAX_DPI)
+    if thumb in (None, "", "0"):
+        thumb = None
+    elif thumb in ("1", "true"):
+        thumb = SCREENSHOT_THUMB_SIZE
+    else:
+        thumb = min(max(int(thumb), 16), 4096)
+    return dpi, "jpeg" if fmt == "jpg" else fmt, thumb
+
+
+def render_page(pdf_path, page_number, dpi, fmt, thumb=None):
+    """Render a 1-based page to image bytes."""
+    with fitz.open(pdf_path) as doc:
+        if page_number < 1 or page_number > len(doc):
+            raise IndexError(f"Page {page_number} out of range (1-{len(doc)})")
+        pix = doc[page_number - 1].get_pixmap(dpi=dpi, alpha=False)
+
+    if fmt == "png" and thumb is None:
+        return pix.tobytes("png")
+
+    from PIL import Image
+
+    image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    if thumb:
+        image.thumbnail((thumb, thumb))
+    buffer = io.BytesIO()
+    pil_format = FORMATS[fmt][0]
+    if pil_format == "PNG":
+        image.save(buffer, pil_format, optimize=True)
+    else:
+        image.save(buffer, pil_format, quality=SCREENSHOT_JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+def get_page_image(folder_prefix, pdf_filename, page_number, pdf_path, dpi, fmt, thumb=None):
+    """Return (bytes, mimetype, hit) for a page, rendering and caching it on a miss."""
+    name = f"{page_number}-{dpi}dpi-{thumb or 'full'}.{fmt}"
+    path = os.path.join(_pages_dir(folder_prefix, pdf_filename), name)
+    mimetype = FORMATS[fmt][1]
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        _touch(path)
+        return data, mimetype, True
+    except FileNotFoundError:
+        pass
+    data = render_page(pdf_path, page_number, dpi, fmt, thumb)
+    _write_atomic(path, data)
+    _account(len(data))
+    return data, mimetype, False
+
+
+def page_count(pdf_path):
+    with fitz.open(pdf_path) as doc:
+        return len(doc)
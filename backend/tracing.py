@@ -0,0 +1,181 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from logging.handlers import RotatingFileHandler
+
+# Local replacement for shipping LangChain traces to an external service. Each request
+# gets a tree of spans that is appended as one JSON line to a rotating file.
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "traces.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv("TRACE_BACKUP_COUNT", "5"))
+
+# Fraction of requests to run under cProfile; 0 disables profiling entirely.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "profiles"))
+
+_local = threading.local()
+_trace_logger = None
+_trace_logger_lock = threading.Lock()
+# cProfile can only have one active profiler at a time, so sampled requests take turns
+_profile_lock = threading.Lock()
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def _new_span(name, attrs):
+    return {
+        "name": name,
+        "start": time.perf_counter(),
+        "end": None,
+        "attrs": attrs,
+        "children": [],
+    }
+
+
+def _get_trace_logger():
+    global _trace_logger
+    if _trace_logger is None:
+        with _trace_logger_lock:
+            if _trace_logger is None:
+                os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+                handler = RotatingFileHandler(TRACE_FILE, maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT)
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                trace_logger = logging.getLogger("amverse.traces")
+                trace_logger.setLevel(logging.INFO)
+                trace_logger.propagate = False
+                trace_logger.addHandler(handler)
+                _trace_logger = trace_logger
+    return _trace_logger
+
+
+def start_trace(name, **attrs):
+    """Open a root span for a request, or a child span if one is already open on this thread.
+
+    Requests forwarded with app.full_dispatch_request run on the same thread, so they
+    show up nested under the request that forwarded them.
+    """
+    stack = _stack()
+    span_obj = _new_span(name, attrs)
+    if stack:
+        stack[-1]["children"].append(span_obj)
+    else:
+        span_obj["trace_id"] = uuid.uuid4().hex
+        span_obj["wall_start"] = time.time()
+        if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+                span_obj["profiler"] = profiler
+            except ValueError:
+                # Another profiler (e.g. a debugger) is already attached
+                _profile_lock.release()
+    stack.append(span_obj)
+    return span_obj
+
+
+def finish_trace(span_obj, **attrs):
+    """Close `span_obj` and anything still open beneath it.
+
+    Returns the finished trace when `span_obj` was the root, otherwise None. Safe to call
+    more than once for the same span.
+    """
+    stack = _stack()
+    if span_obj not in stack:
+        return None
+    now = time.perf_counter()
+    while stack:
+        top = stack.pop()
+        if top["end"] is None:
+            top["end"] = now
+        if top is span_obj:
+            break
+    span_obj["attrs"].update(attrs)
+    if stack:
+        return None
+
+    profiler = span_obj.pop("profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profile_path = os.path.join(PROFILE_DIR, f"{span_obj['name']}-{span_obj['trace_id']}.prof")
+            profiler.dump_stats(profile_path)
+            span_obj["attrs"]["profile"] = profile_path
+        except OSError as e:
+            logging.error(f"Failed to write profile: {e}")
+
+    if TRACE_FILE:
+        try:
+            _get_trace_logger().info(json.dumps(to_dict(span_obj), default=str))
+        except OSError as e:
+            logging.error(f"Failed to write trace: {e}")
+    return span_obj
+
+
+@contextmanager
+def span(name, **attrs):
+    """Record the wrapped block as a child of the current span. No-op outside a trace."""
+    stack = _stack()
+    if not stack:
+        yield None
+        return
+    child = _new_span(name, attrs)
+    stack[-1]["children"].append(child)
+    stack.append(child)
+    try:
+        yield child
+    except Exception as e:
+        child["attrs"]["error"] = type(e).__name__
+        raise
+    finally:
+        child["end"] = time.perf_counter()
+        if stack and stack[-1] is child:
+            stack.pop()
+
+
+def to_dict(span_obj, origin=None):
+    if origin is None:
+        origin = span_obj["start"]
+    end = span_obj["end"] if span_obj["end"] is not None else time.perf_counter()
+    result = {
+        "name": span_obj["name"],
+        "start_ms": round((span_obj["start"] - origin) * 1000, 3),
+        "duration_ms": round((end - span_obj["start"]) * 1000, 3),
+    }
+    for key in ("trace_id", "wall_start"):
+        if key in span_obj:
+            result[key] = span_obj[key]
+    if span_obj["attrs"]:
+        result["attrs"] = span_obj["attrs"]
+    if span_obj["children"]:
+        result["children"] = [to_dict(child, origin) for child in span_obj["children"]]
+    return result
+
+
+def waterfall(span_obj):
+    """Flatten a trace into rows of name/offset/duration/depth, in start order."""
+    rows = []
+
+    def walk(node, depth):
+        rows.append({
+            "name": node["name"],
+            "start_ms": node["start_ms"],
+            "duration_ms": node["duration_ms"],
+            "depth": depth,
+        })
+        for child in node.get("children", []):
+            walk(child, depth + 1)
+
+    walk(to_dict(span_obj), 0)
+    return rows
@@ -0,0 +1,479 @@
+"""Vector store selection: Elastic Cloud (default) or a local memory-mapped store.
+
+VECTOR_STORE_BACKEND=local keeps each index under LOCAL_VECTOR_STORE_DIR/<index_name>/
+as a NumPy matrix of normalized embeddings plus a JSON-lines side file with the chunk
+text and metadata. Search is exact cosine similarity over the memory-mapped matrix, or
+FAISS when LOCAL_VECTOR_SEARCH=faiss and faiss-cpu is installed. For the few hundred
+chunks in a per-user index this answers well under a millisecond with no network.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+from langchain.schema import Document
+from langchain_core.vectorstores import VectorStore
+from langchain_elasticsearch import ElasticsearchStore
+from elasticsearch import Elasticsearch, helpers
+
+try:
+    import fcntl
+except ImportError:  # Windows: cross-process locking is skipped
+    fcntl = None
+
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "elasticsearch").lower()
+LOCAL_VECTOR_STORE_DIR = os.getenv(
+    "LOCAL_VECTOR_STORE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "vector_data")
+)
+# float32 keeps full precision; int8 stores each row scaled to [-127, 127] at a quarter of the size
+LOCAL_VECTOR_DTYPE = os.getenv("LOCAL_VECTOR_DTYPE", "float32").lower()
+LOCAL_VECTOR_SEARCH = os.getenv("LOCAL_VECTOR_SEARCH", "exact").lower()
+# Loaded indices kept in memory; the least recently used is dropped beyond this many
+LOCAL_VECTOR_CACHE_SIZE = int(os.getenv("LOCAL_VECTOR_CACHE_SIZE", "32"))
+# Optional self-hosted Elasticsearch (e.g. a local container); Elastic Cloud is used when unset
+ES_URL = os.getenv("ES_URL")
+
+MANIFEST = "manifest.json"
+
+
+def es_store_kwargs():
+    if ES_URL:
+        return {"es_url": ES_URL}
+    return {"es_cloud_id": os.environ["ES_CLOUD_ID"], "es_api_key": os.environ["ES_API_KEY"]}
+
+
+def es_client():
+    if ES_URL:
+        return Elasticsearch(ES_URL)
+    return Elasticsearch(cloud_id=os.environ["ES_CLOUD_ID"], api_key=os.environ["ES_API_KEY"])
+
+
+def _index_dir(index_name):
+    # Index names are already sanitised by the endpoints, but never let one escape the root
+    safe_name = os.path.basename(index_name.strip().replace(os.sep, "_"))
+    if not safe_name or safe_name in (".", ".."):
+        raise ValueError(f"Invalid index name: {index_name!r}")
+    return os.path.join(LOCAL_VECTOR_STORE_DIR, safe_name)
+
+
+class _IndexLock:
+    """Serialises writers to one index, across threads and (where fcntl exists) processes."""
+    # index_dir -> [lock, holders and waiters]; dropped when the last one leaves
+    _thread_locks = {}
+    _guard = threading.Lock()
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.thread_lock = None
+        # Beside the index rather than inside it, so the lock outlives delete_local_index moving the directory
+        self.path = f"{index_dir}.lock"
+        self.handle = None
+
+    def __enter__(self):
+        with self._guard:
+            entry = self._thread_locks.setdefault(self.index_dir, [threading.Lock(), 0])
+            entry[1] += 1
+        self.thread_lock = entry[0]
+        self.thread_lock.acquire()
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self.handle = open(self.path, "a")
+            if fcntl:
+                fcntl.flock(self.handle, fcntl.LOCK_EX)
+        except BaseException:
+            if self.handle is not None:
+                self.handle.close()
+            self._release_thread_lock()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.handle, fcntl.LOCK_UN)
+        self.handle.close()
+        self._release_thread_lock()
+
+    def _release_thread_lock(self):
+        self.thread_lock.release()
+        with self._guard:
+            entry = self._thread_locks[self.index_dir]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._thread_locks[self.index_dir]
+
+
+def _atomic_write(path, write):
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class _LoadedIndex:
+    def __init__(self, generation, vectors, scales, records):
+        self.generation = generation
+        self.vectors = vectors
+        self.scales = scales
+        self.records = records
+        self.faiss_index = None
+
+
+class LocalVectorStore(VectorStore):
+    """Per-index memory-mapped vectors with a JSON-lines metadata side file.
+
+    Every write produces a new generation of files and then swaps manifest.json in with
+    os.replace, so readers always see either the old or the new index, never a mix.
+    """
+    _cache = OrderedDict()
+    _cache_lock = threading.Lock()
+
+    def __init__(self, embedding, index_name, **kwargs):
+        self.embedding = embedding
+        self.index_name = index_name
+        self.index_dir = _index_dir(index_name)
+
+    @property
+    def embeddings(self):
+        return self.embedding
+
+    # Reading
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.index_dir, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def _load(self, _retry=True):
+        manifest = self._read_manifest()
+        if manifest is None:
+            return None
+        generation = manifest["generation"]
+        with self._cache_lock:
+            cached = self._cache.get(self.index_dir)
+            if cached is not None:
+                self._cache.move_to_end(self.index_dir)
+        if cached is not None and cached.generation == generation:
+            return cached
+
+        prefix = os.path.join(self.index_dir, generation)
+        try:
+            vectors = np.load(f"{prefix}.vectors.npy", mmap_mode="r")
+            scales = np.load(f"{prefix}.scales.npy") if manifest["dtype"] == "int8" else None
+            with open(f"{prefix}.records.jsonl") as f:
+                records = [json.loads(line) for line in f]
+        except FileNotFoundError:
+            # A writer swapped in a newer generation between reading the manifest and the files
+            if _retry:
+                return self._load(_retry=False)
+            raise
+        loaded = _LoadedIndex(generation, vectors, scales, records)
+        with self._cache_lock:
+            self._cache[self.index_dir] = loaded
+            self._cache.move_to_end(self.index_dir)
+            while len(self._cache) > LOCAL_VECTOR_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return loaded
+
+    def _faiss_index(self, loaded):
+        try:
+            import faiss
+        except ImportError:
+            logging.warning("LOCAL_VECTOR_SEARCH=faiss but faiss is not installed; using exact search.")
+            return None
+        if loaded.faiss_index is None:
+            index = faiss.IndexFlatIP(loaded.vectors.shape[1])
+            index.add(self._dense(loaded))
+            loaded.faiss_index = index
+        return loaded.faiss_index
+
+    @staticmethod
+    def _dense(loaded):
+        vectors = np.asarray(loaded.vectors, dtype=np.float32)
+        if loaded.scales is not None:
+            vectors = vectors * loaded.scales[:, None]
+        return np.ascontiguousarray(vectors)
+
+    def _top_k(self, loaded, query, k):
+        faiss_index = self._faiss_index(loaded) if LOCAL_VECTOR_SEARCH == "faiss" else None
+        if faiss_index is not None:
+            scores, positions = faiss_index.search(query[None, :], k)
+            return [(int(p), float(score)) for p, score in zip(positions[0], scores[0]) if p >= 0]
+
+        scores = np.asarray(loaded.vectors, dtype=np.float32) @ query
+        if loaded.scales is not None:
+            scores = scores * loaded.scales
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(p), float(scores[p])) for p in top]
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, **kwargs):
+        loaded = self._load()
+        if loaded is None or not loaded.records:
+            return []
+        query = _normalize(embedding)
+        results = []
+        for position, score in self._top_k(loaded, query, min(k, len(loaded.records))):
+            record = loaded.records[position]
+            results.append((Document(page_content=record["text"], metadata=record["metadata"], id=record["id"]), score))
+        return results
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_by_vector_with_score(self.embedding.embed_query(query), k=k, **kwargs)
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, **kwargs)]
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, **kwargs)]
+
+    def _select_relevance_score_fn(self):
+        # Cosine similarity in [-1, 1] mapped to [0, 1]
+        return lambda score: (score + 1.0) / 2.0
+
+    # Writing
+
+    def _write_generation(self, vectors, records):
+        """Persist a full new generation and atomically point the manifest at it."""
+        generation = uuid.uuid4().hex
+        prefix = os.path.join(self.index_dir, generation)
+        os.makedirs(self.index_dir, exist_ok=True)
+        vectors = np.asarray(vectors, dtype=np.float32)
+
+        if LOCAL_VECTOR_DTYPE == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127.0 if len(vectors) else np.zeros(0, dtype=np.float32)
+            scales[scales == 0] = 1.0
+            stored = np.round(vectors / scales[:, None]).astype(np.int8)
+            _atomic_write(f"{prefix}.scales.npy", lambda f: np.save(f, scales.astype(np.float32)))
+        else:
+            stored = vectors
+        _atomic_write(f"{prefix}.vectors.npy", lambda f: np.save(f, stored))
+        _atomic_write(
+            f"{prefix}.records.jsonl",
+            lambda f: f.write("".join(json.dumps(record, default=str) + "\n" for record in records).encode()),
+        )
+        manifest = {
+            "generation": generation,
+            "dtype": "int8" if LOCAL_VECTOR_DTYPE == "int8" else "float32",
+            "dimensions": int(stored.shape[1]) if stored.ndim == 2 else 0,
+            "count": len(records),
+        }
+        _atomic_write(os.path.join(self.index_dir, MANIFEST), lambda f: f.write(json.dumps(manifest).encode()))
+
+        # Open memmaps of old generations stay valid after unlink, so in-flight searches finish
+        for name in os.listdir(self.index_dir):
+            if name.endswith((".vectors.npy", ".scales.npy", ".records.jsonl")) and not name.startswith(generation):
+                os.remove(os.path.join(self.index_dir, name))
+
+    def _current_rows(self):
+        loaded = self._load()
+        if loaded is None:
+            return np.zeros((0, 0), dtype=np.float32), []
+        return self._dense(loaded), list(loaded.records)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = list(ids) if ids else [uuid.uuid4().hex for _ in texts]
+        new_vectors = _normalize(self.embedding.embed_documents(texts))
+
+        with _IndexLock(self.index_dir):
+            vectors, records = self._current_rows()
+            if len(records):
+                new_vectors = np.vstack([vectors, new_vectors])
+            records.extend(
+                {"id": doc_id, "text": text, "metadata": metadata}
+                for doc_id, text, metadata in zip(ids, texts, metadatas)
+            )
+            self._write_generation(new_vectors, records)
+        return ids
+
+    def add_documents(self, documents, **kwargs):
+        return self.add_texts(
+            [doc.page_content for doc in documents],
+            metadatas=[doc.metadata for doc in documents],
+            **kwargs,
+        )
+
+    def delete(self, ids=None, **kwargs):
+        if ids is None:
+            return delete_local_index(self.index_name)
+        return self._delete_ids(ids) > 0
+
+    def _delete_ids(self, ids):
+        drop = set(ids)
+        with _IndexLock(self.index_dir):
+            vectors, records = self._current_rows()
+            keep = [i for i, record in enumerate(records) if record["id"] not in drop]
+            if len(keep) == len(records):
+                return 0
+            self._write_generation(vectors[keep] if keep else np.zeros((0, vectors.shape[1]), dtype=np.float32),
+                                   [records[i] for i in keep])
+        return len(records) - len(keep)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, index_name=None, **kwargs):
+        store = cls(embedding=embedding, index_name=index_name)
+        store.add_texts(texts, metadatas=metadatas, **kwargs)
+        return store
+
+    @classmethod
+    def from_documents(cls, documents, embedding, index_name=None, **kwargs):
+        store = cls(embedding=embedding, index_name=index_name)
+        store.add_documents(documents, **kwargs)
+        return store
+
+
+def delete_local_index(index_name):
+    index_dir = _index_dir(index_name)
+    # Under the writer lock, so an add_texts in progress either lands before the delete or
+    # starts a fresh index after it, never in the directory being thrown away
+    with _IndexLock(index_dir):
+        if not os.path.isdir(index_dir):
+            return False
+        # Move aside first so a concurrent reader sees either the whole index or none of it
+        trash = f"{index_dir}.deleted-{uuid.uuid4().hex}"
+        os.replace(index_dir, trash)
+        with LocalVectorStore._cache_lock:
+            LocalVectorStore._cache.pop(index_dir, None)
+    shutil.rmtree(trash, ignore_errors=True)
+    return True
+
+
+def get_vector_store(index_name, embedding):
+    if VECTOR_STORE_BACKEND == "local":
+        return LocalVectorStore(embedding=embedding, index_name=index_name)
+    return ElasticsearchStore(embedding=embedding, index_name=index_name, **es_store_kwargs())
+
+
+def index_documents(documents, embedding, index_name):
+    if VECTOR_STORE_BACKEND == "local":
+        return LocalVectorStore.from_documents(documents, embedding=embedding, index_name=index_name)
+    return ElasticsearchStore.from_documents(documents, embedding=embedding, index_name=index_name, **es_store_kwargs())
+
+
+def delete_index(index_name):
+    """Drop an index if it exists. Returns True if something was deleted."""
+    if VECTOR_STORE_BACKEND == "local":
+        return delete_local_index(index_name)
+    client = es_client()
+    if client.indices.exists(index=index_name):
+        client.indices.delete(index=index_name)
+        return True
+    return False
+
+
+def index_size(index_name):
+    """Number of chunks stored in an index, 0 if it doesn't exist."""
+    if VECTOR_STORE_BACKEND == "local":
+        loaded = LocalVectorStore(embedding=None, index_name=index_name)._load()
+        return len(loaded.records) if loaded is not None else 0
+    client = es_client()
+    if not client.indices.exists(index=index_name):
+        return 0
+    return client.count(index=index_name)["count"]
+
+
+def _scan_metadata(index_name, field, values):
+    """Yield (id, metadata) of the stored chunks whose metadata `field`, or any item of it, is in `values`."""
+    values = list(set(values))
+    if not values:
+        return
+    if VECTOR_STORE_BACKEND == "local":
+        loaded = LocalVectorStore(embedding=None, index_name=index_name)._load()
+        if loaded is None:
+            return
+        wanted = set(values)
+        for record in loaded.records:
+            value = record["metadata"].get(field)
+            if wanted.intersection(value if isinstance(value, list) else (value,)):
+                yield record["id"], record["metadata"]
+        return
+
+    client = es_client()
+    if not client.indices.exists(index=index_name):
+        return
+    seen = set()
+    # Stay well under the default 65536-term limit of a terms query
+    for start in range(0, len(values), 4096):
+        query = {"query": {"terms": {f"metadata.{field}.keyword": values[start:start + 4096]}}}
+        for hit in helpers.scan(client, index=index_name, query=query, _source=["metadata"]):
+            if hit["_id"] not in seen:
+                seen.add(hit["_id"])
+                yield hit["_id"], hit["_source"]["metadata"]
+
+
+def find_by_metadata(index_name, field, values):
+    """Metadata of the stored chunks whose metadata `field` (or any item of a list-valued one) is in `values`."""
+    return [metadata for _, metadata in _scan_metadata(index_name, field, values)]
+
+
+def ids_by_metadata(index_name, field, values):
+    """Ids of the stored chunks whose metadata `field` is in `values`, for delete_ids()."""
+    return [doc_id for doc_id, _ in _scan_metadata(index_name, field, values)]
+
+
+def delete_ids(index_name, ids):
+    """Delete chunks by id. Returns how many were deleted."""
+    ids = list(ids)
+    if not ids:
+        return 0
+    if VECTOR_STORE_BACKEND == "local":
+        return LocalVectorStore(embedding=None, index_name=index_name)._delete_ids(ids)
+    client = es_client()
+    actions = ({"_op_type": "delete", "_index": index_name, "_id": doc_id} for doc_id in ids)
+    # Chunks already deleted by a concurrent replace come back as 404s; that is fine
+    deleted, _ = helpers.bulk(client, actions, raise_on_error=False)
+    return deleted
+
+
+def backfill_metadata(index_name, field, compute):
+    """Merge compute(text) into the metadata of every chunk that has no `field` yet. Returns how many changed."""
+    if VECTOR_STORE_BACKEND == "local":
+        store = LocalVectorStore(embedding=None, index_name=index_name)
+        with _IndexLock(store.index_dir):
+            vectors, records = store._current_rows()
+            # Copies: the loaded records are shared with concurrent readers through the cache
+            records = [dict(record) for record in records]
+            updated = 0
+            for record in records:
+                if field not in record["metadata"]:
+                    record["metadata"] = {**record["metadata"], **compute(record["text"])}
+                    updated += 1
+            if updated:
+                store._write_generation(vectors, records)
+        return updated
+
+    client = es_client()
+    if not client.indices.exists(index=index_name):
+        return 0
+    query = {"query": {"bool": {"must_not": {"exists": {"field": f"metadata.{field}"}}}}}
+    actions = (
+        {"_op_type": "update", "_index": index_name, "_id": hit["_id"], "doc": {"metadata": compute(hit["_source"]["text"])}}
+        for hit in helpers.scan(client, index=index_name, query=query, _source=["text"])
+    )
+    updated, _ = helpers.bulk(client, actions)
+    return updated